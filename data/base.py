@@ -14,6 +14,115 @@ class DataLoaderExt(DataLoader):
         return self.dataset.ny
 
 
+class TensorLoader(object):
+    """Batch loader for in-memory IODatasets with the interface of DataLoaderExt. The batchified data of the dataset is
+    held as one torch tensor per signal and the batches are gathered by indexing along the batch axis, i.e. without
+    worker processes and without a collate function. The batches have the shape (batch, n_channels, seq_len) or
+    (seq_len, batch, n_channels) for time major datasets."""
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, stateful=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        # stateful: batches of consecutive windows, see __iter__
+        self.stateful = stateful
+
+        # batch axis of the stored tensors
+        self.batch_dim = 1 if dataset.time_major else 0
+        self.u = self._to_tensor(dataset.u)
+        self.y = self._to_tensor(dataset.y)
+
+    def _to_tensor(self, x):
+        # batchified data of the dataset (number of batches first) to a contiguous tensor with the batch axis batch_dim
+        x = torch.from_numpy(x)
+        if self.dataset.time_major:
+            x = x.permute(1, 0, 2)
+        return x.contiguous()
+
+    @property
+    def nu(self):
+        return self.dataset.nu
+
+    @property
+    def ny(self):
+        return self.dataset.ny
+
+    @property
+    def time_major(self):
+        return self.dataset.time_major
+
+    @property
+    def n_samples(self):
+        return self.u.shape[self.batch_dim]
+
+    def to(self, device):
+        # keep the data on device, e.g. the computing device such that the batches need no transfer in every step
+        self.u = self.u.to(device)
+        self.y = self.y.to(device)
+        return self
+
+    def subset(self, idx, batch_size=None, shuffle=False):
+        # loader over the samples idx (copy of the data on the same device)
+        loader = TensorLoader.__new__(TensorLoader)
+        loader.dataset = self.dataset
+        loader.batch_size = self.batch_size if batch_size is None else batch_size
+        loader.shuffle = shuffle
+        loader.stateful = False
+        loader.batch_dim = self.batch_dim
+        idx = torch.as_tensor(idx, device=self.u.device)
+        loader.u = self.u.index_select(self.batch_dim, idx)
+        loader.y = self.y.index_select(self.batch_dim, idx)
+        return loader
+
+    def shard(self, rank, world_size, batch_size=None, drop_remainder=True):
+        # loader over the contiguous part rank of world_size parts of the samples (data parallel training). With
+        # drop_remainder, the remaining samples are dropped such that all shards have the same number of batches
+        if drop_remainder:
+            n_shard = self.n_samples // world_size
+            idx = torch.arange(rank * n_shard, (rank + 1) * n_shard)
+        else:
+            idx = torch.arange(self.n_samples).tensor_split(world_size)[rank]
+        loader = self.subset(idx, batch_size, self.shuffle)
+        loader.stateful = self.stateful
+        return loader
+
+    @property
+    def n_streams(self):
+        # number of streams of consecutive windows in stateful mode (one per sample of a batch)
+        return min(self.batch_size, self.n_samples)
+
+    def __len__(self):
+        if self.stateful:
+            return self.n_samples // self.n_streams
+        # number of batches per epoch (the last batch may be smaller)
+        return (self.n_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.n_samples == 0:
+            # empty shard
+            return
+        if self.stateful:
+            # the windows of the dataset are consecutive parts of the signals: the data is split into n_streams
+            # streams of consecutive windows and the batch k holds the k-th window of every stream, such that the
+            # final state of a batch is the initial state of the next one (remaining windows are dropped, no shuffling)
+            n_windows = len(self)
+            offsets = torch.arange(self.n_streams, device=self.u.device) * n_windows
+            for k in range(n_windows):
+                yield self.u.index_select(self.batch_dim, offsets + k), self.y.index_select(self.batch_dim, offsets + k)
+        elif self.batch_size >= self.n_samples:
+            # full batch: the data itself (the order of the samples within a batch does not matter)
+            yield self.u, self.y
+        elif self.shuffle:
+            idx = torch.randperm(self.n_samples, device=self.u.device)
+            for batch_idx in idx.split(self.batch_size):
+                yield self.u.index_select(self.batch_dim, batch_idx), self.y.index_select(self.batch_dim, batch_idx)
+        else:
+            # fixed slices: views of the data without copies
+            for start in range(0, self.n_samples, self.batch_size):
+                length = min(self.batch_size, self.n_samples - start)
+                yield self.u.narrow(self.batch_dim, start, length), self.y.narrow(self.batch_dim, start, length)
+
+
 class IODataset(Dataset):
     """Create dataset from data.
     Parameters
@@ -24,14 +133,19 @@ class IODataset(Dataset):
         Maximum length for a batch on, respectively. If `seq_len` is smaller than the total
         data length, the data will be further divided in batches. If None,
         put the entire dataset on a single batch.
+    time_major: bool (optional)
+        If True, the samples have the contiguous shape (seq_len, n_channels) and are batched
+        to (seq_len, batch, n_channels) by TensorLoader.
+        Otherwise (default) the samples have the shape (n_channels, seq_len).
     """
-    def __init__(self, u, y, seq_len=None):
+    def __init__(self, u, y, seq_len=None, time_major=False):
         if seq_len is None:
             seq_len = u.shape[0]
-        self.u = IODataset._batchify(u.astype(np.float32), seq_len)
-        self.y = IODataset._batchify(y.astype(np.float32), seq_len)
+        self.time_major = time_major
+        self.u = IODataset._batchify(u.astype(np.float32), seq_len, time_major)
+        self.y = IODataset._batchify(y.astype(np.float32), seq_len, time_major)
         self.ntotbatch = self.u.shape[0]
-        self.seq_len = self.u.shape[2]
+        self.seq_len = self.u.shape[1] if time_major else self.u.shape[2]
         self.nu = 1 if u.ndim == 1 else u.shape[1]
         self.ny = 1 if y.ndim == 1 else y.shape[1]
 
@@ -42,7 +156,7 @@ class IODataset(Dataset):
         return self.u[idx, ...], self.y[idx, ...]
 
     @staticmethod
-    def _batchify(x, seq_len):
+    def _batchify(x, seq_len, time_major=False):
         # data should be a torch tensor
         # data should have size (total number of samples) times (number of signals)
         # The output has size (number of batches) times (number of signals) times (batch size)
@@ -55,8 +169,13 @@ class IODataset(Dataset):
         #    data = np.transpose(data, (1, 2, 0))
         # Evenly divide the data across the batch_size batches and make sure it is still in temporal order
         #    data = data.reshape((nbatch, 1, seq_len)).transpose(0, 1, 2)
-        x = x.reshape((seq_len, nbatch, -1), order='F').transpose(1, 2, 0)
+        x = x.reshape((seq_len, nbatch, -1), order='F')
+        if time_major:
+            # size (number of batches) times (batch size) times (number of signals), contiguous per batch
+            return np.ascontiguousarray(x.transpose(1, 0, 2))
+        x = x.transpose(1, 2, 0)
         # data = data.view(nbatch, batch_size, -1).transpose(0, 1)
         # ## arg = np.zeros([1, 2], dtype=np.float32)
 
         return x
+
@@ -1,4 +1,4 @@
-from data.base import DataLoaderExt
+from data.base import TensorLoader
 # from data.cascaded_tank import create_cascadedtank_datasets
 # from data.f16gvt import create_f16gvt_datasets
 from data.narendra_li import create_narendra_li_datasets
@@ -6,7 +6,7 @@ from data.toy_lgssm import create_toy_lgssm_datasets
 from data.wiener_hammerstein import create_wienerhammerstein_datasets
 
 
-def load_dataset(dataset, dataset_options, train_batch_size, test_batch_size, **kwargs):
+def load_dataset(dataset, dataset_options, train_batch_size, test_batch_size, time_major=False, **kwargs):
     """Not used datasets: F16 and Cascadedtank"""
     """if dataset == 'cascaded_tank':
         dataset_train, dataset_valid, dataset_test = create_cascadedtank_datasets(dataset_options.seq_len_train,
@@ -29,30 +29,33 @@ def load_dataset(dataset, dataset_options, train_batch_size, test_batch_size, **
         dataset_train, dataset_valid, dataset_test = create_narendra_li_datasets(dataset_options.seq_len_train,
                                                                                  dataset_options.seq_len_val,
                                                                                  dataset_options.seq_len_test,
+                                                                                 time_major=time_major,
                                                                                  **kwargs)
         # Dataloader
-        loader_train = DataLoaderExt(dataset_train, batch_size=train_batch_size, shuffle=True, num_workers=1)
-        loader_valid = DataLoaderExt(dataset_valid, batch_size=test_batch_size, shuffle=False, num_workers=1)
-        loader_test = DataLoaderExt(dataset_test, batch_size=test_batch_size, shuffle=False, num_workers=1)
+        loader_train = TensorLoader(dataset_train, batch_size=train_batch_size, shuffle=True)
+        loader_valid = TensorLoader(dataset_valid, batch_size=test_batch_size, shuffle=False)
+        loader_test = TensorLoader(dataset_test, batch_size=test_batch_size, shuffle=False)
     elif dataset == 'toy_lgssm':
         dataset_train, dataset_valid, dataset_test = create_toy_lgssm_datasets(dataset_options.seq_len_train,
                                                                                dataset_options.seq_len_val,
                                                                                dataset_options.seq_len_test,
+                                                                               time_major=time_major,
                                                                                **kwargs)
         # Dataloader
-        loader_train = DataLoaderExt(dataset_train, batch_size=train_batch_size, shuffle=True, num_workers=1)
-        loader_valid = DataLoaderExt(dataset_valid, batch_size=test_batch_size, shuffle=False, num_workers=1)
-        loader_test = DataLoaderExt(dataset_test, batch_size=test_batch_size, shuffle=False, num_workers=1)
+        loader_train = TensorLoader(dataset_train, batch_size=train_batch_size, shuffle=True)
+        loader_valid = TensorLoader(dataset_valid, batch_size=test_batch_size, shuffle=False)
+        loader_test = TensorLoader(dataset_test, batch_size=test_batch_size, shuffle=False)
 
     elif dataset == 'wiener_hammerstein':
         dataset_train, dataset_valid, dataset_test = create_wienerhammerstein_datasets(dataset_options.seq_len_train,
                                                                                        dataset_options.seq_len_val,
                                                                                        dataset_options.seq_len_test,
+                                                                                       time_major=time_major,
                                                                                        **kwargs)
         # Dataloader
-        loader_train = DataLoaderExt(dataset_train, batch_size=train_batch_size, shuffle=True, num_workers=1)
-        loader_valid = DataLoaderExt(dataset_valid, batch_size=test_batch_size, shuffle=False, num_workers=1)
-        loader_test = DataLoaderExt(dataset_test, batch_size=test_batch_size, shuffle=False, num_workers=1)
+        loader_train = TensorLoader(dataset_train, batch_size=train_batch_size, shuffle=True)
+        loader_valid = TensorLoader(dataset_valid, batch_size=test_batch_size, shuffle=False)
+        loader_test = TensorLoader(dataset_test, batch_size=test_batch_size, shuffle=False)
 
     else:
         raise Exception("Dataset not implemented: {}".format(dataset))
@@ -31,7 +31,7 @@ def run_narendra_li_sim(u):
     return y
 
 
-def create_narendra_li_datasets(seq_len_train=None, seq_len_val=None, seq_len_test=None, **kwargs):
+def create_narendra_li_datasets(seq_len_train=None, seq_len_val=None, seq_len_test=None, time_major=False, **kwargs):
     # define output noise
     sigma_out = np.sqrt(0.1)
 
@@ -66,8 +66,8 @@ def create_narendra_li_datasets(seq_len_train=None, seq_len_val=None, seq_len_te
     u_val = u_val.transpose(1, 0)
     y_val = y_val.transpose(1, 0)
 
-    dataset_train = IODataset(u_train, y_train, seq_len_train)
-    dataset_val = IODataset(u_val, y_val, seq_len_val)
-    dataset_test = IODataset(u_test, y_test, seq_len_test)
+    dataset_train = IODataset(u_train, y_train, seq_len_train, time_major)
+    dataset_val = IODataset(u_val, y_val, seq_len_val, time_major)
+    dataset_test = IODataset(u_test, y_test, seq_len_test, time_major)
 
     return dataset_train, dataset_val, dataset_test
@@ -29,7 +29,7 @@ def run_toy_lgssm_sim(u, A, B, C, sigma_state, sigma_out):
     return y
 
 
-def create_toy_lgssm_datasets(seq_len_train=None, seq_len_val=None, seq_len_test=None, **kwargs):
+def create_toy_lgssm_datasets(seq_len_train=None, seq_len_val=None, seq_len_test=None, time_major=False, **kwargs):
     # state space matrices
     A = np.array([[0.7, 0.8], [0, 0.1]])
     B = np.array([[-1], [0.1]])
@@ -68,8 +68,8 @@ def create_toy_lgssm_datasets(seq_len_train=None, seq_len_val=None, seq_len_test
     u_val = u_val.transpose(1, 0)
     y_val = y_val.transpose(1, 0)
 
-    dataset_train = IODataset(u_train, y_train, seq_len_train)
-    dataset_val = IODataset(u_val, y_val, seq_len_val)
-    dataset_test = IODataset(u_test, y_test, seq_len_test)
+    dataset_train = IODataset(u_train, y_train, seq_len_train, time_major)
+    dataset_val = IODataset(u_val, y_val, seq_len_val, time_major)
+    dataset_test = IODataset(u_test, y_test, seq_len_test, time_major)
 
     return dataset_train, dataset_val, dataset_test
@@ -5,7 +5,8 @@ import numpy as np
 from data.base import IODataset
 
 
-def create_wienerhammerstein_datasets(seq_len_train=None, seq_len_val=None, seq_len_test=None, **kwargs):
+def create_wienerhammerstein_datasets(seq_len_train=None, seq_len_val=None, seq_len_test=None, time_major=False,
+                                      **kwargs):
     # which data set to use
     if 'test_set' in kwargs:
         test_set = kwargs['test_set']
@@ -98,8 +99,8 @@ def create_wienerhammerstein_datasets(seq_len_train=None, seq_len_val=None, seq_
     u_val = u_val[..., None]
     y_val = y_val[..., None]
 
-    dataset_train = IODataset(u_train, y_train, seq_len_train)
-    dataset_val = IODataset(u_val, y_val, seq_len_val)
-    dataset_test = IODataset(u_test, y_test, seq_len_test)
+    dataset_train = IODataset(u_train, y_train, seq_len_train, time_major)
+    dataset_val = IODataset(u_val, y_val, seq_len_val, time_major)
+    dataset_test = IODataset(u_test, y_test, seq_len_test, time_major)
 
     return dataset_train, dataset_val, dataset_test
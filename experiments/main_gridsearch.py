@@ -90,6 +90,7 @@ def run_main_gridsearch(options, kwargs, gridvalues, path_general, file_name_gen
                                               dataset_options=options["dataset_options"],
                                               train_batch_size=options["train_options"].batch_size,
                                               test_batch_size=options["test_options"].batch_size,
+                                              time_major=options["model_options"].time_major,
                                               **kwargs)
 
                 # Compute normalizers
@@ -94,6 +94,7 @@ def run_main_ndata(options, vary_data, path_general, file_name_general, params):
                                       dataset_options=options["dataset_options"],
                                       train_batch_size=options["train_options"].batch_size,
                                       test_batch_size=options["test_options"].batch_size,
+                                      time_major=options["model_options"].time_major,
                                       **kwargs)
 
         # Compute normalizers
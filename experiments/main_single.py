@@ -28,6 +28,9 @@ from models.model_state import ModelState
 ########################################################################################################################
 def run_main_single(options, path_general, file_name_general):
     start_time = time.time()
+    # data parallel training if started as several processes (e.g. torchrun --nproc_per_node N main_single.py on
+    # localhost or with --nnodes and --rdzv_endpoint across nodes), rank 0 does the logging, saving and testing
+    rank, world_size = training.init_distributed()
     print('Run file: main_single.py')
     print(time.strftime("%c"))
 
@@ -37,6 +40,8 @@ def run_main_single(options, path_general, file_name_general):
     else:
         device = torch.device('cpu')
     print('Device: {}'.format(device))
+    if world_size > 1:
+        print('Process {} of {}'.format(rank, world_size))
 
     # get the options
     options['device'] = device
@@ -54,17 +59,18 @@ def run_main_single(options, path_general, file_name_general):
                                                                   options['model_options'].z_dim,
                                                                   options['model_options'].n_layers)
     path = path_general + 'data/'
-    # check if path exists and create otherwise
-    if not os.path.exists(path):
-        os.makedirs(path)
-    # set logger
-    set_redirects(path, file_name_general)
+    # check if path exists and create otherwise (logger of rank 0 only)
+    if rank == 0:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        set_redirects(path, file_name_general)
 
     # Specifying datasets
     loaders = loader.load_dataset(dataset=options["dataset"],
                                   dataset_options=options["dataset_options"],
                                   train_batch_size=options["train_options"].batch_size,
-                                  test_batch_size=options["test_options"].batch_size, )
+                                  test_batch_size=options["test_options"].batch_size,
+                                  time_major=options["model_options"].time_major, )
 
     # Compute normalizers
     if options["normalize"]:
@@ -82,19 +88,27 @@ def run_main_single(options, path_general, file_name_general):
     modelstate.model.to(options['device'])
 
     # save the options
-    save_options(options, path_general, 'options.txt')
+    if rank == 0:
+        save_options(options, path_general, 'options.txt')
 
     # allocation
     df = {}
     if options['do_train']:
         # train the model
-        df = training.run_train(modelstate=modelstate,
-                                loader_train=loaders['train'],
-                                loader_valid=loaders['valid'],
-                                options=options,
-                                dataframe=df,
-                                path_general=path_general,
-                                file_name_general=file_name_general)
+        run_train = training.resume_train if options['resume'] else training.run_train
+        df = run_train(modelstate=modelstate,
+                       loader_train=loaders['train'],
+                       loader_valid=loaders['valid'],
+                       options=options,
+                       dataframe=df,
+                       path_general=path_general,
+                       file_name_general=file_name_general)
+
+    if world_size > 1:
+        # end of the data parallel training, the other processes are done
+        torch.distributed.destroy_process_group()
+        if rank > 0:
+            return
 
     if options['do_test']:
         # test the model
@@ -129,6 +143,7 @@ if __name__ == "__main__":
         'dataset': 'toy_lgssm',  # options: 'narendra_li', 'toy_lgssm', 'wiener_hammerstein'
         'model': 'STORN', # options: 'VAE-RNN', 'VRNN-Gauss', 'VRNN-Gauss-I', 'VRNN-GMM', 'VRNN-GMM-I', 'STORN'
         'do_train': True,
+        'resume': False,  # continue an interrupted training from its last resume checkpoint
         'do_test': True,
         'logdir': 'single',
         'normalize': True,
@@ -162,6 +162,7 @@ if __name__ == "__main__":
                                                             dataset_options=options["dataset_options"],
                                                             train_batch_size=options["train_options"].batch_size,
                                                             test_batch_size=options["test_options"].batch_size,
+                                                            time_major=options["model_options"].time_major,
                                                             **kwargs)
 
                     kwargs = {'test_set': 'sweptsine', 'MCiter': mcIter}
@@ -169,6 +170,7 @@ if __name__ == "__main__":
                                                             dataset_options=options["dataset_options"],
                                                             train_batch_size=options["train_options"].batch_size,
                                                             test_batch_size=options["test_options"].batch_size,
+                                                            time_major=options["model_options"].time_major,
                                                             **kwargs)
 
                     # Compute normalizers
@@ -87,6 +87,7 @@ def get_perf_results(path_general, model_name):
                                                             dataset_options=options["dataset_options"],
                                                             train_batch_size=options["train_options"].batch_size,
                                                             test_batch_size=options["test_options"].batch_size,
+                                                            time_major=options["model_options"].time_major,
                                                             **kwargs)
 
                     kwargs = {'test_set': 'sweptsine', 'MCiter': mcIter}
@@ -94,6 +95,7 @@ def get_perf_results(path_general, model_name):
                                                             dataset_options=options["dataset_options"],
                                                             train_batch_size=options["train_options"].batch_size,
                                                             test_batch_size=options["test_options"].batch_size,
+                                                            time_major=options["model_options"].time_major,
                                                             **kwargs)
 
                     # Compute normalizers
@@ -81,6 +81,7 @@ if __name__ == "__main__":
                                   dataset_options=options["dataset_options"],
                                   train_batch_size=options["train_options"].batch_size,
                                   test_batch_size=options["test_options"].batch_size,
+                                  time_major=options["model_options"].time_major,
                                   **kwargs)
 
     if options['do_test']:
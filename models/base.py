@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from enum import Enum
 import numpy as np
 
@@ -12,22 +13,31 @@ class Normalizer1D(nn.Module):
         self.register_buffer('scale', torch.tensor(scale, dtype=torch.float32) + self._epsilon)
         self.register_buffer('offset', torch.tensor(offset, dtype=torch.float32))
 
-    def normalize(self, x):
+    def normalize(self, x, time_major=False):
+        # x of shape (batch, channels, seq_len) or (seq_len, batch, channels) if time_major
+        if time_major:
+            return (x - self.offset) / self.scale
         x = x.permute(0, 2, 1)
         x = (x - self.offset) / self.scale
         return x.permute(0, 2, 1)
 
-    def unnormalize(self, x):
+    def unnormalize(self, x, time_major=False):
+        if time_major:
+            return x * self.scale + self.offset
         x = x.permute(0, 2, 1)
         x = x * self.scale + self.offset
         return x.permute(0, 2, 1)
 
-    def unnormalize_mean(self, x_mu):
+    def unnormalize_mean(self, x_mu, time_major=False):
+        if time_major:
+            return x_mu * self.scale + self.offset
         x_mu = x_mu.permute(0, 2, 1)
         x_mu = x_mu * self.scale + self.offset
         return x_mu.permute(0, 2, 1)
 
-    def unnormalize_sigma(self, x_sigma):
+    def unnormalize_sigma(self, x_sigma, time_major=False):
+        if time_major:
+            return x_sigma * self.scale
         x_sigma = x_sigma.permute(0, 2, 1)
         x_sigma = x_sigma * self.scale
         return x_sigma.permute(0, 2, 1)
@@ -48,3 +58,108 @@ class DynamicModule(nn.Module):
         if self.has_internal_state:
             raise NotImplementedError
 
+
+
+class StepwiseFeatures(object):
+    """Feature extraction evaluated lazily at every time step, i.e. phi(x[t]) for x of shape (seq_len, batch, channels).
+    Indexing by the time step t gives the features of shape (batch, h_dim)."""
+
+    def __init__(self, phi, x):
+        self.phi = phi
+        self.x = x
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def __getitem__(self, t):
+        return self.phi(self.x[t])
+
+
+def to_time_major(x, time_major=False):
+    # view of x of shape (batch, channels, seq_len) as (seq_len, batch, channels), x is returned as is if already
+    # time_major (the models work on the time major layout internally)
+    if time_major:
+        return x
+    return x.permute(2, 0, 1)
+
+
+def from_time_major(x, time_major=False):
+    # inverse of to_time_major
+    if time_major:
+        return x
+    return x.permute(1, 2, 0)
+
+
+def extract_features(phi, x, precompute=True):
+    # feature extraction of the time major signal x with shape (seq_len, batch, channels)
+    # precompute: phi is evaluated once over all time steps as a single batched operation and the time major
+    # features of shape (seq_len, batch, h_dim) are returned, such that features[t] is a contiguous slice
+    # otherwise: phi is evaluated at every time step when indexing features[t]
+    if precompute:
+        return phi(x)
+    return StepwiseFeatures(phi, x)
+
+
+def time_steps(x):
+    # time steps of time major features x as a tuple of views (StepwiseFeatures are returned as they are). Compared to
+    # indexing x[t] inside the time loop, the backward pass stacks the gradients of all time steps once instead of
+    # accumulating a gradient of the full size of x for every single time step
+    if torch.is_tensor(x):
+        return x.unbind(0)
+    return x
+
+
+def run_steps(step, state, inputs, seq_len, segment_len=0):
+    # time loop of the inference model: state_t+1, outputs_t = step(state_t, inputs(t)) for all time steps, returns the
+    # final state and the outputs (tuple of tensors) of all time steps stacked to shape (seq_len, ...) such that the
+    # loss is evaluated once for the whole sequence instead of accumulated step by step
+    # segment_len > 0: gradient checkpointing along time, i.e. the segments of segment_len time steps are evaluated
+    # without storing any activations and evaluated again (with the same random numbers) in the backward pass, only the
+    # states, inputs and outputs at the segments are kept. This reduces the memory from O(seq_len) to
+    # O(seq_len / segment_len + segment_len) time steps at the cost of a second forward evaluation
+    if segment_len <= 0 or not torch.is_grad_enabled():
+        return _run_segment(step, state, (inputs(t) for t in range(seq_len)))
+    outputs = []
+    for start in range(0, seq_len, segment_len):
+        segment_inputs = [inputs(t) for t in range(start, min(start + segment_len, seq_len))]
+        # all tensors of the segment are explicit arguments of the checkpoint, such that their gradients are returned
+        tensors = _leaves((state, segment_inputs))
+
+        def run(*tensors_segment, structure=(state, segment_inputs)):
+            state_segment, inputs_segment = _replace_leaves(structure, iter(tensors_segment))
+            state_out, outputs_out = _run_segment(step, state_segment, inputs_segment)
+            return tuple(_leaves(state_out)) + outputs_out
+
+        segment_outputs = torch.utils.checkpoint.checkpoint(run, *tensors, use_reentrant=True)
+        n_state = len(tensors) - len(_leaves(segment_inputs))
+        state = _replace_leaves(state, iter(segment_outputs[:n_state]))
+        outputs.append(segment_outputs[n_state:])
+
+    return state, tuple(torch.cat(outputs_i, 0) for outputs_i in zip(*outputs))
+
+
+def _run_segment(step, state, inputs):
+    outputs = []
+    for inputs_t in inputs:
+        state, outputs_t = step(state, inputs_t)
+        outputs.append(outputs_t)
+
+    return state, tuple(torch.stack(outputs_i, 0) for outputs_i in zip(*outputs))
+
+
+def _leaves(x):
+    # tensors of nested tuples and lists in order
+    if torch.is_tensor(x):
+        return [x]
+    if isinstance(x, (tuple, list)):
+        return [leaf for item in x for leaf in _leaves(item)]
+    return []
+
+
+def _replace_leaves(x, leaves):
+    # x with its tensors replaced by the next items of the iterator leaves
+    if torch.is_tensor(x):
+        return next(leaves)
+    if isinstance(x, (tuple, list)):
+        return type(x)(_replace_leaves(item, leaves) for item in x)
+    return x
@@ -0,0 +1,28 @@
+import functools
+import torch
+
+"""compiled step functions of the models. The step functions are compiled once per architecture and shared between all
+model instances of that architecture (e.g. the runs of a grid search), since the unbound step function is compiled and
+the model is passed as an argument."""
+
+# attributes of a model which define its architecture
+_ARCHITECTURE = ('y_dim', 'u_dim', 'h_dim', 'z_dim', 'n_layers', 'n_mixtures', 'split_input_layers', 'fused_gru')
+
+# cache of compiled step functions
+_compiled_steps = {}
+
+
+def architecture_key(model, name):
+    return (type(model).__name__, name) + tuple(getattr(model, attr, None) for attr in _ARCHITECTURE)
+
+
+def get_step(model, name='step'):
+    # step function of model (bound method), compiled if model.compile_step is set
+    if not getattr(model, 'compile_step', False):
+        return getattr(model, name)
+
+    key = architecture_key(model, name)
+    if key not in _compiled_steps:
+        _compiled_steps[key] = torch.compile(getattr(type(model), name))
+
+    return functools.partial(_compiled_steps[key], model)
@@ -35,31 +35,57 @@ class DynamicModel(nn.Module):
         else:
             raise Exception("Unimplemented model")
 
+        # run the time loops of the model through the compiled step functions
+        self.m.compile_step = model_options.compile_step
+        # layout of u and y: (seq_len, batch, channels) if time_major, otherwise (batch, channels, seq_len)
+        self.time_major = model_options.time_major
+        # bfloat16 mixed precision (autocast) of the model, the normalizers are evaluated in float32 outside
+        self.mixed_precision = model_options.mixed_precision
+        self.device_type = torch.device(options['device']).type
+
+    def check_layout(self, loader):
+        # the layout of the batches of loader has to be the one of the model, i.e. load_dataset(..., time_major=
+        # model_options.time_major)
+        if loader.time_major != self.time_major:
+            raise Exception("Data layout of the loader (time_major={}) does not match the model (time_major={})"
+                            .format(loader.time_major, self.time_major))
+
+    def autocast(self):
+        # autocast region of the model evaluation (inactive if not mixed_precision)
+        return torch.autocast(self.device_type, dtype=torch.bfloat16, enabled=self.mixed_precision)
+
     @property
     def num_model_inputs(self):
         return self.num_inputs + self.num_outputs if self.ar else self.num_inputs
 
-    def forward(self, u, y=None):
+    def forward(self, u, y=None, noise=None, state=None, return_state=False):
         if self.normalizer_input is not None:
-            u = self.normalizer_input.normalize(u)
+            u = self.normalizer_input.normalize(u, self.time_major)
         if y is not None and self.normalizer_output is not None:
-            y = self.normalizer_output.normalize(y)
+            y = self.normalizer_output.normalize(y, self.time_major)
 
-        loss = self.m(u, y)
+        # state: initial recurrent state of the model (None: zeros), returned as (loss, final state) if return_state
+        with self.autocast():
+            loss = self.m(u, y, noise, state, return_state)
 
         return loss
 
-    def generate(self, u, y=None):
+    def generate(self, u, y=None, noise=None):
         if self.normalizer_input is not None:
-            u = self.normalizer_input.normalize(u)
+            u = self.normalizer_input.normalize(u, self.time_major)
 
-        y_sample, y_sample_mu, y_sample_sigma = self.m.generate(u)
+        # noise: optional dict of noise blocks of shape (seq_len, batch, dim) of the samples ('z' and 'y' standard normal,
+        # 'mixture' uniform), e.g. to simulate several models or inputs with the same noise realization
+        with self.autocast():
+            y_sample, y_sample_mu, y_sample_sigma = self.m.generate(u, noise)
+        # outputs of the mixed precision evaluation in float32
+        y_sample, y_sample_mu, y_sample_sigma = y_sample.float(), y_sample_mu.float(), y_sample_sigma.float()
 
         if self.normalizer_output is not None:
-            y_sample = self.normalizer_output.unnormalize(y_sample)
+            y_sample = self.normalizer_output.unnormalize(y_sample, self.time_major)
         if self.normalizer_output is not None:
-            y_sample_mu = self.normalizer_output.unnormalize_mean(y_sample_mu)
+            y_sample_mu = self.normalizer_output.unnormalize_mean(y_sample_mu, self.time_major)
         if self.normalizer_output is not None:
-            y_sample_sigma = self.normalizer_output.unnormalize_sigma(y_sample_sigma)
+            y_sample_sigma = self.normalizer_output.unnormalize_sigma(y_sample_sigma, self.time_major)
 
         return y_sample, y_sample_mu, y_sample_sigma
@@ -0,0 +1,105 @@
+import functools
+import math
+import torch
+from .base import time_steps
+
+"""Gaussian kernels on mean and log-variance tensors (without torch.distributions objects). All functions are
+element-wise or summed over all elements like the loss terms of the models."""
+
+LOG_2PI = math.log(2 * math.pi)
+
+
+def float32(fn):
+    # evaluates the loss term fn in float32: tensor arguments of lower precision (outputs of the layers within mixed
+    # precision autocast regions) are cast, such that the element-wise terms and their sums are in full precision
+    @functools.wraps(fn)
+    def wrapper(*args):
+        return fn(*(x.float() for x in args))
+
+    return wrapper
+
+
+def sample_gauss(mu, logvar, eps=None):
+    # reparameterized sample of N(mu, exp(logvar)) with standard normal noise eps (drawn if not given), same as
+    # tdist.Normal(mu, logvar.exp().sqrt()).rsample()
+    if eps is None:
+        eps = torch.randn_like(mu)
+    return mu + logvar.exp().sqrt() * eps
+
+
+def log_gauss(x, mu, logvar):
+    # element-wise log-density of x under N(mu, exp(logvar))
+    return -0.5 * ((x - mu) ** 2 / logvar.exp() + logvar + LOG_2PI)
+
+
+@float32
+def loglikelihood_gauss(x, mu, logvar):
+    # log-likelihood of x under N(mu, exp(logvar)) summed over all elements
+    return torch.sum(log_gauss(x, mu, logvar))
+
+
+@float32
+def kld_gauss(mu_q, logvar_q, mu_p, logvar_p):
+    # Goal: Minimize KL divergence between q_pi(z|xi) || p(z|xi)
+    # This is equivalent to maximizing the ELBO: - D_KL(q_phi(z|xi) || p(z)) + Reconstruction term
+    # This is equivalent to minimizing D_KL(q_phi(z|xi) || p(z))
+    term1 = logvar_p - logvar_q - 1
+    term2 = (torch.exp(logvar_q) + (mu_q - mu_p) ** 2) / torch.exp(logvar_p)
+    kld = 0.5 * torch.sum(term1 + term2)
+
+    return kld
+
+
+@float32
+def kld_std_gauss(mu_q, logvar_q):
+    # KL divergence D_KL(q || N(0,1)), same as kld_gauss with mu_p = 0 and logvar_p = 0
+    kld = 0.5 * torch.sum(- logvar_q - 1 + torch.exp(logvar_q) + mu_q ** 2)
+
+    return kld
+
+
+@float32
+def loglikelihood_gmm(x, mu, logvar, pi):
+    # log-likelihood of x of shape (..., y_dim) under Gaussian mixtures with means mu, log-variances logvar and weights
+    # pi of shape (..., y_dim, n_mixtures) summed over all elements. The weights are normalized per channel (dec_pi of
+    # the models applies the softmax over all channels and mixtures at once). Weights which underflow to zero are
+    # clamped to the smallest positive value, log(0) would give NaN gradients for all logits of the softmax
+    log_pi = torch.log(pi.clamp_min(torch.finfo(pi.dtype).tiny)) - torch.log(pi.sum(-1, keepdim=True))
+    loglike = torch.logsumexp(log_pi + log_gauss(x.unsqueeze(-1), mu, logvar), -1)
+
+    return torch.sum(loglike)
+
+
+def sample_gmm(mu, logvar, pi, uniform=None, eps=None):
+    # sample of the Gaussian mixtures with parameters of shape (..., y_dim, n_mixtures). The mixture component is drawn
+    # by Gumbel-max, argmax_k log(pi_k) - log(-log(u_k)) with uniform noise u of the same shape (drawn if not given),
+    # and selected along the mixture axis. Returns the sample (with standard normal noise eps), mean and std of the
+    # selected components
+    if uniform is None:
+        uniform = torch.rand_like(pi)
+    idx = torch.argmax(torch.log(pi) - torch.log(-torch.log(uniform)), -1, keepdim=True)
+    mu_sel = torch.gather(mu, -1, idx).squeeze(-1)
+    logvar_sel = torch.gather(logvar, -1, idx).squeeze(-1)
+
+    return sample_gauss(mu_sel, logvar_sel, eps), mu_sel, logvar_sel.exp().sqrt()
+
+
+def draw_noise(noise, name, shape, device, predraw=True):
+    # noise block of shape (seq_len, batch, ...) of the samples of name ('z' and 'y' standard normal, 'mixture'
+    # uniform): the block noise[name] if given (dict of blocks, e.g. for reproducible simulations), a block drawn
+    # upfront with a single call of the random number generator if predraw or None if the noise is drawn within every
+    # time step
+    if noise is not None and name in noise:
+        return noise[name].to(device)
+    if predraw:
+        draw = torch.rand if name == 'mixture' else torch.randn
+        return draw(shape, device=device)
+    return None
+
+
+def noise_steps(noise, name, shape, device, predraw=True):
+    # time steps of draw_noise (None in every time step if the noise is drawn within the steps)
+    block = draw_noise(noise, name, shape, device, predraw)
+    if block is None:
+        return (None,) * shape[0]
+    return time_steps(block)
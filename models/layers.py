@@ -0,0 +1,223 @@
+import itertools
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from .base import StepwiseFeatures
+
+"""layers acting on the concatenation [x_a, x_b] of an input x_a and the recurrent state x_b which keep the weight
+blocks of both parts separate, i.e. W [x_a, x_b] + b = (W_a x_a + b) + W_b x_b. The part of x_a can be computed upfront
+for the whole sequence whenever x_a does not depend on the recurrent state and no concatenation is needed inside the
+time loop."""
+
+
+class SplitLinear(nn.Module):
+    def __init__(self, in_features_a, in_features_b, out_features, bias=True):
+        super(SplitLinear, self).__init__()
+
+        self.in_features_a = in_features_a
+        self.in_features_b = in_features_b
+        self.out_features = out_features
+
+        self.weight_a = nn.Parameter(torch.empty(out_features, in_features_a))
+        self.weight_b = nn.Parameter(torch.empty(out_features, in_features_b))
+        if bias:
+            self.bias = nn.Parameter(torch.empty(out_features))
+        else:
+            self.register_parameter('bias', None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same initialization (and random number consumption) as nn.Linear on the concatenated input
+        linear = nn.Linear(self.in_features_a + self.in_features_b, self.out_features, self.bias is not None)
+        with torch.no_grad():
+            self.weight_a.copy_(linear.weight[:, :self.in_features_a])
+            self.weight_b.copy_(linear.weight[:, self.in_features_a:])
+            if self.bias is not None:
+                self.bias.copy_(linear.bias)
+
+    def project_a(self, x_a):
+        return F.linear(x_a, self.weight_a, self.bias)
+
+    def project_b(self, x_b):
+        return F.linear(x_b, self.weight_b)
+
+    def forward(self, x_a, x_b):
+        return self.project_a(x_a) + self.project_b(x_b)
+
+    def extra_repr(self):
+        return 'in_features_a={}, in_features_b={}, out_features={}, bias={}'.format(
+            self.in_features_a, self.in_features_b, self.out_features, self.bias is not None)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # weight converter: split the weight of a nn.Linear on the concatenated input (e.g. of older checkpoints)
+        weight = state_dict.pop(prefix + 'weight', None)
+        if weight is not None:
+            weight_a, weight_b = weight.split([self.in_features_a, self.in_features_b], 1)
+            state_dict[prefix + 'weight_a'] = weight_a
+            state_dict[prefix + 'weight_b'] = weight_b
+        super(SplitLinear, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                                       unexpected_keys, error_msgs)
+
+
+class FusedGRU(nn.GRU):
+    """Step engine for nn.GRU (same parameters, state dict and full sequence forward) inside a time loop. All layers are
+    evaluated in a single step call. If the input is known ahead of time, the input projections (gates) of the first
+    layer are computed for all time steps in one operation with project_input and each step only adds the hidden state
+    projection. Otherwise, step_input evaluates the fused GRU cells on the raw input."""
+
+    def layer_weights(self, layer):
+        # weight_ih, weight_hh, bias_ih, bias_hh of a single layer (biases are None for bias=False)
+        return (getattr(self, 'weight_ih_l{}'.format(layer)),
+                getattr(self, 'weight_hh_l{}'.format(layer)),
+                getattr(self, 'bias_ih_l{}'.format(layer), None),
+                getattr(self, 'bias_hh_l{}'.format(layer), None))
+
+    def project_input(self, x):
+        # input projection of the first layer
+        weight_ih, _, bias_ih, _ = self.layer_weights(0)
+        return F.linear(x, weight_ih, bias_ih)
+
+    def step(self, gi, h):
+        # single time step with the input projection gi of the first layer and the hidden state h of shape
+        # (num_layers, batch, hidden_size), returns the new hidden state
+        _, weight_hh, _, bias_hh = self.layer_weights(0)
+        h_new = [gru_cell(gi, h[0], weight_hh, bias_hh)]
+        for layer in range(1, self.num_layers):
+            h_new.append(self.cell(layer, h_new[-1], h[layer]))
+
+        return torch.stack(h_new, 0)
+
+    def step_input(self, x, h):
+        # single time step on the input x (fallback if the input is not known ahead of time)
+        h_new = [x]
+        for layer in range(self.num_layers):
+            h_new.append(self.cell(layer, h_new[-1], h[layer]))
+
+        return torch.stack(h_new[1:], 0)
+
+    def cell(self, layer, x, h):
+        # GRU cell of a single layer with the projections as F.linear, such that they run in lower precision within
+        # autocast regions as the other layers of the models (torch.gru_cell is evaluated in float32)
+        weight_ih, weight_hh, bias_ih, bias_hh = self.layer_weights(layer)
+        return gru_cell(F.linear(x, weight_ih, bias_ih), h, weight_hh, bias_hh)
+
+
+class SplitGRU(FusedGRU):
+    """FusedGRU with an input [x_a, x_b] of the first layer. Parameters and state dict are the ones of nn.GRU, the
+    weight of the first layer is split column wise at evaluation."""
+
+    def __init__(self, input_size_a, input_size_b, hidden_size, num_layers=1, bias=True):
+        super(SplitGRU, self).__init__(input_size_a + input_size_b, hidden_size, num_layers, bias)
+        self.input_size_a = input_size_a
+
+    def project_a(self, x_a):
+        # input projection of x_a in the first layer
+        weight_ih, _, bias_ih, _ = self.layer_weights(0)
+        return F.linear(x_a, weight_ih[:, :self.input_size_a], bias_ih)
+
+    def step_split(self, x_a, x_b, h):
+        # single time step with x_a given by project_a(x_a)
+        weight_ih, _, _, _ = self.layer_weights(0)
+        return self.step(x_a + F.linear(x_b, weight_ih[:, self.input_size_a:]), h)
+
+
+def gru_cell(gi, h, weight_hh, bias_hh=None):
+    # GRU cell with given input projection gi = W_ih x + b_ih (same equations as nn.GRU)
+    gh = F.linear(h, weight_hh, bias_hh)
+    i_r, i_z, i_n = gi.chunk(3, -1)
+    h_r, h_z, h_n = gh.chunk(3, -1)
+    r = torch.sigmoid(i_r + h_r)
+    z = torch.sigmoid(i_z + h_z)
+    n = torch.tanh(i_n + r * h_n)
+
+    return n + z * (h - n)
+
+
+def concat_linear(in_features_a, in_features_b, out_features, split=False):
+    # linear layer on the concatenated input [x_a, x_b]
+    if split:
+        return SplitLinear(in_features_a, in_features_b, out_features)
+    return nn.Linear(in_features_a + in_features_b, out_features)
+
+
+def concat_gru(input_size_a, input_size_b, hidden_size, num_layers=1, bias=True, split=False, fused=False):
+    # GRU on the concatenated input [x_a, x_b]
+    if split:
+        return SplitGRU(input_size_a, input_size_b, hidden_size, num_layers, bias)
+    if fused:
+        return FusedGRU(input_size_a + input_size_b, hidden_size, num_layers, bias)
+    return nn.GRU(input_size_a + input_size_b, hidden_size, num_layers, bias)
+
+
+def project_input(layer, x_a):
+    # part of layer (nn.Sequential starting with concat_linear or concat_gru) which only depends on the input x_a
+    if isinstance(x_a, StepwiseFeatures):
+        # features evaluated in every time step: project in every time step as well
+        return StepwiseFeatures(lambda x_t: project_input(layer, x_a.phi(x_t)), x_a.x)
+    first = layer if isinstance(layer, nn.GRU) else layer[0]
+    if isinstance(first, (SplitLinear, SplitGRU)):
+        return first.project_a(x_a)
+    if isinstance(first, FusedGRU) and x_a.shape[-1] == first.input_size:
+        # x_a is the full input: gates of the first layer
+        return first.project_input(x_a)
+    return x_a
+
+
+def forward_with_state(layer, x_a, x_b):
+    # evaluate layer (nn.Sequential starting with concat_linear) on [x_a, x_b] with x_a given by project_input
+    first = layer[0]
+    if isinstance(first, SplitLinear):
+        out = x_a + first.project_b(x_b)
+    else:
+        out = first(torch.cat([x_a, x_b], -1))
+    for module in itertools.islice(layer, 1, None):
+        out = module(out)
+
+    return out
+
+
+def rnn_step(rnn, x_a, x_b, h):
+    # single time step of rnn (nn.GRU, FusedGRU or concat_gru) on [x_a, x_b] or on x_a only (x_b=None) with x_a given
+    # by project_input and returning the new state
+    if isinstance(rnn, SplitGRU):
+        return rnn.step_split(x_a, x_b, h)
+    if isinstance(rnn, FusedGRU):
+        if x_b is None:
+            return rnn.step(x_a, h)
+        return rnn.step_input(torch.cat([x_a, x_b], -1), h)
+    x = x_a if x_b is None else torch.cat([x_a, x_b], -1)
+    _, h = rnn(x.unsqueeze(0), h)
+
+    return h
+
+
+def split_optimizer_state(model, optimizer_state):
+    # converts the optimizer state dict of a checkpoint where all SplitLinear layers of model were still nn.Linear
+    # layers on the concatenated input to the parameters of model (parameters are enumerated in order of model.modules())
+    state = optimizer_state['state']
+    new_state = {}
+    idx_old = 0
+    idx_new = 0
+    for module in model.modules():
+        n_params = len(list(module.parameters(recurse=False)))
+        if isinstance(module, SplitLinear):
+            # weight -> weight_a, weight_b
+            if idx_old in state:
+                parts = [slice(None, module.in_features_a), slice(module.in_features_a, None)]
+                for idx_part, part in enumerate(parts):
+                    new_state[idx_new + idx_part] = {key: value[:, part].clone() if torch.is_tensor(value) and
+                                                     value.dim() == 2 else value
+                                                     for key, value in state[idx_old].items()}
+            idx_old += 1
+            idx_new += 2
+            n_params -= 2
+        for _ in range(n_params):
+            if idx_old in state:
+                new_state[idx_new] = state[idx_old]
+            idx_old += 1
+            idx_new += 1
+
+    param_groups = [dict(optimizer_state['param_groups'][0], params=list(range(idx_new)))]
+
+    return {'state': new_state, 'param_groups': param_groups}
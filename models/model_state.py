@@ -1,8 +1,10 @@
 import torch
 
 from models import DynamicModel
+from models.layers import split_optimizer_state
 import torch.optim as optim
 import os.path
+import threading
 
 
 class ModelState:
@@ -21,26 +23,135 @@ class ModelState:
         # Optimization parameters
         self.optimizer = getattr(optim, options['optim'])(self.model.parameters(), lr=options['train_options'].init_lr)
 
+        # background writer of save_model(..., blocking=False), started on first use
+        self.checkpoint_writer = None
+
     def load_model(self, path, name='model.pt'):
+        ckpt = self.load_checkpoint(path, name)
+        epoch = ckpt['epoch']
+        return epoch
+
+    def load_checkpoint(self, path, name='model.pt'):
+        # loads model and optimizer and returns the whole checkpoint (including e.g. the training state to resume)
         file = path if os.path.isfile(path) else os.path.join(path, name)
         try:
             ckpt = torch.load(file, map_location=lambda storage, loc: storage)
-        except NotADirectoryError:
+        except (NotADirectoryError, FileNotFoundError):
             raise Exception("Could not find model: " + file)
         self.model.load_state_dict(ckpt["model"])
-        self.optimizer.load_state_dict(ckpt["optimizer"])
-        epoch = ckpt['epoch']
-        return epoch
+        # checkpoints with concatenated input layers are split automatically (see SplitLinear), adapt the optimizer too
+        optimizer_state = ckpt["optimizer"]
+        if any(key[:-len('_a')] in ckpt["model"] for key in self.model.state_dict() if key.endswith('.weight_a')):
+            optimizer_state = split_optimizer_state(self.model, optimizer_state)
+        self.optimizer.load_state_dict(optimizer_state)
+        return ckpt
 
-    def save_model(self, epoch, vloss, elapsed_time,  path, name='model.pt'):
-        # check if path exists and create otherwise
-        if not os.path.exists(path):
-            os.makedirs(path)
-        torch.save({
+    def save_model(self, epoch, vloss, elapsed_time,  path, name='model.pt', blocking=True, state=None):
+        # blocking=False: snapshot of the state in memory, written to disk by a background thread (see CheckpointWriter)
+        # state: additional entries of the checkpoint, e.g. the training state to resume
+        ckpt = {
                 'epoch': epoch,
                 'model': self.model.state_dict(),
                 'optimizer': self.optimizer.state_dict(),
                 'vloss': vloss,
                 'elapsed_time': elapsed_time,
-            },
-            os.path.join(path, name))
+            }
+        if state is not None:
+            ckpt.update(state)
+        if blocking:
+            write_checkpoint(ckpt, os.path.join(path, name))
+            return
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter()
+        self.checkpoint_writer.submit(snapshot(ckpt), os.path.join(path, name))
+
+    def wait_checkpoints(self):
+        # block until all checkpoints of save_model(..., blocking=False) are on disk and stop the background thread (a
+        # new one is started by the next save_model(..., blocking=False))
+        if self.checkpoint_writer is not None:
+            checkpoint_writer, self.checkpoint_writer = self.checkpoint_writer, None
+            checkpoint_writer.close()
+
+
+def write_checkpoint(ckpt, file):
+    # atomic write: the checkpoint is saved to a temporary file in the same directory which then replaces file, hence
+    # file is either the old or the new checkpoint but never a partially written one
+    path = os.path.dirname(file)
+    # check if path exists and create otherwise
+    if path and not os.path.exists(path):
+        os.makedirs(path)
+    file_tmp = file + '.tmp'
+    torch.save(ckpt, file_tmp)
+    os.replace(file_tmp, file)
+
+
+def snapshot(obj):
+    # copy of all tensors of a (nested) state dict on the cpu, independent of further training steps
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints on a background thread. Checkpoints per file are coalesced: if several checkpoints of the
+    same file are submitted while a write is in flight, only the latest one is written afterwards. Errors of the
+    background writes are raised by the next submit, flush or close."""
+
+    def __init__(self):
+        self._pending = {}
+        self._busy = False
+        self._error = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='CheckpointWriter', daemon=True)
+        self._thread.start()
+
+    def submit(self, ckpt, file):
+        with self._cond:
+            self._raise_error()
+            # replaces a pending, not yet written checkpoint of the same file
+            self._pending[file] = ckpt
+            self._cond.notify_all()
+
+    def flush(self):
+        with self._cond:
+            while self._pending or self._busy:
+                self._cond.wait()
+            self._raise_error()
+
+    def close(self):
+        # writes the pending checkpoints and stops the thread
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    # closed and all checkpoints written
+                    return
+                file, ckpt = self._pending.popitem()
+                self._busy = True
+            try:
+                write_checkpoint(ckpt, file)
+            except Exception as error:
+                with self._cond:
+                    self._error = error
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
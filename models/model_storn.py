@@ -2,7 +2,10 @@ import torch
 import torch.nn as nn
 import torch.utils
 import torch.utils.data
-import torch.distributions as tdist
+from .base import extract_features, to_time_major, from_time_major, run_steps
+from .layers import concat_gru, project_input, rnn_step
+from .gaussian import sample_gauss, loglikelihood_gauss, kld_std_gauss, draw_noise, noise_steps
+from .compiled_step import get_step
 
 """implementation of the STOchastich Recurent Neural network (STORN) from https://arxiv.org/abs/1411.7610 using
 unimodal isotropic gaussian distributions for inference, prior, and generating models."""
@@ -18,6 +21,11 @@ class STORN(nn.Module):
         self.d_dim = self.h_dim  # choose d and h recurrence of same size
         self.z_dim = param.z_dim
         self.n_layers = param.n_layers
+        self.precompute_features = param.precompute_features
+        self.fused_gru = param.fused_gru
+        self.predraw_noise = param.predraw_noise
+        self.time_major = param.time_major
+        self.checkpoint_segment = param.checkpoint_segment
         self.device = device
 
         # feature-extracting transformations (phi_y, phi_u and phi_z)
@@ -69,116 +77,228 @@ class STORN(nn.Module):
             nn.ReLU(),)
 
         # generation recurrence function (f_theta) -> Recurrence of h
-        self.rnn_gen = nn.GRU(self.h_dim + self.h_dim, self.h_dim, self.n_layers, bias)
+        self.rnn_gen = concat_gru(self.h_dim, self.h_dim, self.h_dim, self.n_layers, bias, fused=self.fused_gru)
 
         # inference recurrence function (f_theta) -> Recurrence of d
         self.rnn_inf = nn.GRU(self.d_dim, self.d_dim, self.n_layers, bias)
 
-    def forward(self, u, y):
+    def forward(self, u, y, noise=None, state=None, return_state=False):
+        # state: initial recurrent states (h, d), e.g. the final states of the previous window (truncated BPTT),
+        # returned after the loss if return_state
+        if not self.precompute_features:
+            return self._forward_stepwise(u, y, noise, state, return_state)
+
+        # time major views (seq_len, batch, channels)
+        u = to_time_major(u, self.time_major)
+        y = to_time_major(y, self.time_major)
+        # feature extraction: y and u for all time steps, shape (seq_len, batch, h_dim)
+        phi_y = extract_features(self.phi_y, y)
+        phi_u = extract_features(self.phi_u, u)
+
+        # inference recurrence: d_t, y_t -> d_t+1 (only driven by y, hence one call for all time steps)
+        if state is None:
+            h_init, d_init = None, torch.zeros(self.n_layers, y.shape[1], self.d_dim, device=self.device)
+        else:
+            h_init, d_init = state
+        d, d_final = self.rnn_inf(phi_y, d_init)
+
+        # encoder: d_t -> z_t
+        enc = self.enc(d)
+        enc_mean = self.enc_mean(enc)
+        enc_logvar = self.enc_logvar(enc)
+
+        # sampling and reparameterization: get z_t for all time steps
+        z = sample_gauss(enc_mean, enc_logvar, draw_noise(noise, 'z', enc_mean.shape, self.device, False))
+        # feature extraction: z_t
+        phi_z = self.phi_z(z)
+
+        # recurrence: u_t+1, z_t, h_t -> h_t+1
+        h, h_final = self._recurrence_gen(phi_u, phi_z, h_init)
+
+        # decoder: h_t -> y_t
+        dec = self.dec(h)
+        dec_mean = self.dec_mean(dec)
+        dec_logvar = self.dec_logvar(dec)
+
+        # computing the loss over all time steps (KLD to the prior z_t ~ N(0,1))
+        KLD = kld_std_gauss(enc_mean, enc_logvar)
+        loss_pred = loglikelihood_gauss(y, dec_mean, dec_logvar)
+        loss = - loss_pred + KLD
+
+        if return_state:
+            return loss, (h_final, d_final)
+        return loss
+
+    def generate(self, u, noise=None):
+        if not self.precompute_features:
+            return self._generate_stepwise(u, noise)
+
+        # time major view (seq_len, batch, channels)
+        u = to_time_major(u, self.time_major)
+        # get the batch size
+        batch_size = u.shape[1]
+        # length of the sequence to generate
+        seq_len = u.shape[0]
+
+        # feature extraction: u for all time steps, shape (seq_len, batch, h_dim)
+        phi_u = extract_features(self.phi_u, u)
+
+        # prior: z_t ~ N(0,1) does not depend on the recurrence, hence drawn for all time steps at once
+        z = draw_noise(noise, 'z', (seq_len, batch_size, self.z_dim), self.device)
+        # feature extraction: z_t
+        phi_z = self.phi_z(z)
+
+        # recurrence: u_t+1, z_t, h_t -> h_t+1
+        h, _ = self._recurrence_gen(phi_u, phi_z)
+
+        # decoder: h_t -> y_t
+        dec = self.dec(h)
+        dec_mean = self.dec_mean(dec)
+        dec_logvar = self.dec_logvar(dec)
+        # samples
+        sample = sample_gauss(dec_mean, dec_logvar, draw_noise(noise, 'y', dec_mean.shape, self.device, False))
+
+        # back to the layout of u
+        sample = from_time_major(sample, self.time_major)
+        sample_mu = from_time_major(dec_mean, self.time_major)
+        sample_sigma = from_time_major(dec_logvar.exp().sqrt(), self.time_major)
+
+        return sample, sample_mu, sample_sigma
+
+    def _recurrence_gen(self, phi_u, phi_z, h_init=None):
+        # hidden state h_t of the last layer for all time steps with h_0 = h_init (default 0) and
+        # h_t+1 = f(phi_u_t, phi_z_t, h_t) and the final state of all layers
+        # the inputs of the generative recurrence are known upfront, hence one call of the GRU over the full sequence
+        if h_init is None:
+            h_init = torch.zeros(self.n_layers, phi_u.shape[1], self.h_dim, device=self.device)
+        h_out, h_final = self.rnn_gen(torch.cat([phi_u, phi_z], 2), h_init)
+
+        return torch.cat([h_init[-1:], h_out[:-1]], 0), h_final
+
+    def _forward_stepwise(self, u, y, noise=None, state=None, return_state=False):
+        # time major views (seq_len, batch, channels)
+        u = to_time_major(u, self.time_major)
+        y = to_time_major(y, self.time_major)
         #  batch size
-        batch_size = y.shape[0]
-        seq_len = y.shape[2]
+        batch_size = y.shape[1]
+        seq_len = y.shape[0]
 
-        # allocation
-        loss = 0
         # initialization
-        h = torch.zeros(self.n_layers, batch_size, self.h_dim, device=self.device)
-        d = torch.zeros(self.n_layers, batch_size, self.d_dim, device=self.device)
+        if state is None:
+            h = torch.zeros(self.n_layers, batch_size, self.h_dim, device=self.device)
+            d = torch.zeros(self.n_layers, batch_size, self.d_dim, device=self.device)
+        else:
+            h, d = state
+
+        # feature extraction: y and u for all time steps
+        phi_y = extract_features(self.phi_y, y, precompute=False)
+        phi_u = extract_features(self.phi_u, u, precompute=False)
+        # input projection of u which does not depend on the recurrence
+        rnn_u = project_input(self.rnn_gen, phi_u)
+
+        # noise of the samples of z_t
+        eps_z = noise_steps(noise, 'z', (seq_len, batch_size, self.z_dim), self.device, self.predraw_noise)
+
+        # for all time steps (segments of checkpoint_segment time steps evaluated again in the backward pass)
+        (h, d), outputs = run_steps(get_step(self, 'step'), (h, d), lambda t: (phi_y[t], rnn_u[t], eps_z[t]), seq_len,
+                                    self.checkpoint_segment)
+        # distribution parameters of all time steps, shape (seq_len, batch, dim)
+        enc_mean, enc_logvar, dec_mean, dec_logvar = outputs
+
+        # computing the loss over all time steps (KLD to the prior z_t ~ N(0,1))
+        KLD = kld_std_gauss(enc_mean, enc_logvar)
+        loss_pred = loglikelihood_gauss(y, dec_mean, dec_logvar)
+        loss = - loss_pred + KLD
+
+        if return_state:
+            return loss, (h, d)
+        return loss
 
-        # constant so can be outside of loop
-        # prior: z_t ~ N(0,1) (for KLD loss)
-        prior_mean_t = torch.zeros([batch_size, self.z_dim], device=self.device)
-        prior_logvar_t = torch.zeros([batch_size, self.z_dim], device=self.device)
+    def step(self, state, inputs):
+        # single time step of the inference model: (h_t, d_t), (phi_y_t, rnn_u_t, eps_z_t) -> (h_t+1, d_t+1),
+        # (distribution parameters of step t) with the features phi_y_t of y_t, the input projection rnn_u_t of u_t and
+        # the noise eps_z_t of the sample of z_t (the loss is evaluated for all time steps at once)
+        h, d = state
+        phi_y_t, rnn_u_t, eps_z_t = inputs
 
-        # for all time steps
-        for t in range(seq_len):
-            # feature extraction: y_t
-            phi_y_t = self.phi_y(y[:, :, t])
-            # feature extraction: u_t
-            phi_u_t = self.phi_u(u[:, :, t])
-
-            # inference recurrence: d_t, x_t -> d_t+1
-            _, d = self.rnn_inf(phi_y_t.unsqueeze(0), d)
-
-            # encoder: d_t -> z_t
-            enc_t = self.enc(d[-1])
-            enc_mean_t = self.enc_mean(enc_t)
-            enc_logvar_t = self.enc_logvar(enc_t)
-
-            # sampling and reparameterization: get a new z_t
-            temp = tdist.Normal(enc_mean_t, enc_logvar_t.exp().sqrt())
-            z_t = tdist.Normal.rsample(temp)
-            # feature extraction: z_t
-            phi_z_t = self.phi_z(z_t)
-
-            # decoder: h_t -> y_t
-            dec_t = self.dec(h[-1])
-            dec_mean_t = self.dec_mean(dec_t)
-            dec_logvar_t = self.dec_logvar(dec_t)
-            pred_dist = tdist.Normal(dec_mean_t, dec_logvar_t.exp().sqrt())
-
-            # recurrence: u_t+1, z_t, h_t -> h_t+1
-            _, h = self.rnn_gen(torch.cat([phi_u_t, phi_z_t], 1).unsqueeze(0), h)
-
-            # computing the loss
-            KLD = self.kld_gauss(enc_mean_t, enc_logvar_t, prior_mean_t, prior_logvar_t)
-            loss_pred = torch.sum(pred_dist.log_prob(y[:, :, t]))
-            loss += - loss_pred + KLD
+        # inference recurrence: d_t, x_t -> d_t+1
+        _, d = self.rnn_inf(phi_y_t.unsqueeze(0), d)
 
-        return loss
+        # encoder: d_t -> z_t
+        enc_t = self.enc(d[-1])
+        enc_mean_t = self.enc_mean(enc_t)
+        enc_logvar_t = self.enc_logvar(enc_t)
+
+        # sampling and reparameterization: get a new z_t
+        z_t = sample_gauss(enc_mean_t, enc_logvar_t, eps_z_t)
+        # feature extraction: z_t
+        phi_z_t = self.phi_z(z_t)
 
-    def generate(self, u):
+        # decoder: h_t -> y_t
+        dec_t = self.dec(h[-1])
+        dec_mean_t = self.dec_mean(dec_t)
+        dec_logvar_t = self.dec_logvar(dec_t)
+
+        # recurrence: u_t+1, z_t, h_t -> h_t+1
+        h = rnn_step(self.rnn_gen, rnn_u_t, phi_z_t, h)
+
+        return (h, d), (enc_mean_t, enc_logvar_t, dec_mean_t, dec_logvar_t)
+
+    def _generate_stepwise(self, u, noise=None):
+        # time major view (seq_len, batch, channels)
+        u = to_time_major(u, self.time_major)
         # get the batch size
-        batch_size = u.shape[0]
+        batch_size = u.shape[1]
         # length of the sequence to generate
-        seq_len = u.shape[-1]
+        seq_len = u.shape[0]
 
         # allocation
-        sample = torch.zeros(batch_size, self.y_dim, seq_len, device=self.device)
-        sample_mu = torch.zeros(batch_size, self.y_dim, seq_len, device=self.device)
-        sample_sigma = torch.zeros(batch_size, self.y_dim, seq_len, device=self.device)
+        sample = torch.zeros(seq_len, batch_size, self.y_dim, device=self.device)
+        sample_mu = torch.zeros(seq_len, batch_size, self.y_dim, device=self.device)
+        sample_sigma = torch.zeros(seq_len, batch_size, self.y_dim, device=self.device)
 
         h = torch.zeros(self.n_layers, batch_size, self.h_dim, device=self.device)
 
-        # constnt so can be outside of loop
-        # prior: z_t ~ N(0,1)
-        prior_mean_t = torch.zeros([batch_size, self.z_dim], device=self.device)
-        prior_logvar_t = torch.zeros([batch_size, self.z_dim], device=self.device)
+        # feature extraction: u for all time steps
+        phi_u = extract_features(self.phi_u, u, precompute=False)
+        # input projection of u which does not depend on the recurrence
+        rnn_u = project_input(self.rnn_gen, phi_u)
+
+        # noise of the samples of z_t and y_t
+        eps_z = noise_steps(noise, 'z', (seq_len, batch_size, self.z_dim), self.device, self.predraw_noise)
+        eps_y = noise_steps(noise, 'y', (seq_len, batch_size, self.y_dim), self.device, self.predraw_noise)
 
         # for all time steps
+        step = get_step(self, 'step_generate')
         for t in range(seq_len):
-            # feature extraction: u_t+1
-            phi_u_t = self.phi_u(u[:, :, t])
-
-            # sampling and reparameterization: get new z_t
-            temp = tdist.Normal(prior_mean_t, prior_logvar_t.exp().sqrt())
-            z_t = tdist.Normal.rsample(temp)
-            # feature extraction: z_t
-            phi_z_t = self.phi_z(z_t)
-
-            # decoder: h_t -> y_t
-            dec_t = self.dec(h[-1])
-            dec_mean_t = self.dec_mean(dec_t)
-            dec_logvar_t = self.dec_logvar(dec_t)
-            # store the samples
-            temp = tdist.Normal(dec_mean_t, dec_logvar_t.exp().sqrt())
-            sample[:, :, t] = tdist.Normal.rsample(temp)
-            # store mean and std
-            sample_mu[:, :, t] = dec_mean_t
-            sample_sigma[:, :, t] = dec_logvar_t.exp().sqrt()
-
-            # recurrence: u_t+1, z_t -> h_t+1
-            _, h = self.rnn_gen(torch.cat([phi_u_t, phi_z_t], 1).unsqueeze(0), h)
+            h, (sample[t], sample_mu[t], sample_sigma[t]) = step(h, (rnn_u[t], eps_z[t], eps_y[t]))
+
+        # back to the layout of u
+        sample = from_time_major(sample, self.time_major)
+        sample_mu = from_time_major(sample_mu, self.time_major)
+        sample_sigma = from_time_major(sample_sigma, self.time_major)
 
         return sample, sample_mu, sample_sigma
 
-    @staticmethod
-    def kld_gauss(mu_q, logvar_q, mu_p, logvar_p):
-        # Goal: Minimize KL divergence between q_pi(z|xi) || p(z|xi)
-        # This is equivalent to maximizing the ELBO: - D_KL(q_phi(z|xi) || p(z)) + Reconstruction term
-        # This is equivalent to minimizing D_KL(q_phi(z|xi) || p(z))
-        term1 = logvar_p - logvar_q - 1
-        term2 = (torch.exp(logvar_q) + (mu_q - mu_p) ** 2) / torch.exp(logvar_p)
-        kld = 0.5 * torch.sum(term1 + term2)
+    def step_generate(self, h, inputs):
+        # single time step of the generative model: h_t, (rnn_u_t, eps_z_t, eps_y_t) -> h_t+1, (sample_t, mean_t, std_t)
+        # with the input projection rnn_u_t of u_t and the noise eps_z_t and eps_y_t of the samples of z_t and y_t
+        rnn_u_t, eps_z_t, eps_y_t = inputs
 
-        return kld
+        # prior: z_t ~ N(0,1)
+        z_t = torch.randn(h.shape[1], self.z_dim, device=h.device) if eps_z_t is None else eps_z_t
+        # feature extraction: z_t
+        phi_z_t = self.phi_z(z_t)
+
+        # decoder: h_t -> y_t
+        dec_t = self.dec(h[-1])
+        dec_mean_t = self.dec_mean(dec_t)
+        dec_logvar_t = self.dec_logvar(dec_t)
+        dec_sigma_t = dec_logvar_t.exp().sqrt()
+        # sample
+        sample_t = sample_gauss(dec_mean_t, dec_logvar_t, eps_y_t)
+
+        # recurrence: u_t+1, z_t -> h_t+1
+        h = rnn_step(self.rnn_gen, rnn_u_t, phi_z_t, h)
+
+        return h, (sample_t, dec_mean_t, dec_sigma_t)
@@ -1,6 +1,9 @@
 import torch
 import torch.nn as nn
-import torch.distributions as tdist
+from .base import extract_features, time_steps, to_time_major, from_time_major, run_steps
+from .layers import concat_linear, concat_gru, project_input, forward_with_state, rnn_step
+from .gaussian import sample_gauss, loglikelihood_gauss, kld_gauss, noise_steps
+from .compiled_step import get_step
 
 """implementation of the Variational Recurrent Neural Network (VRNN-Gauss) from https://arxiv.org/abs/1506.02216 using
 unimodal isotropic gaussian distributions for inference, prior, and generating models."""
@@ -15,6 +18,12 @@ class VRNN_Gauss(nn.Module):
         self.h_dim = param.h_dim
         self.z_dim = param.z_dim
         self.n_layers = param.n_layers
+        self.precompute_features = param.precompute_features
+        self.split_input_layers = param.split_input_layers
+        self.fused_gru = param.fused_gru
+        self.predraw_noise = param.predraw_noise
+        self.time_major = param.time_major
+        self.checkpoint_segment = param.checkpoint_segment
         self.device = device
 
         # feature-extracting transformations (phi_y, phi_u and phi_z)
@@ -33,7 +42,7 @@ class VRNN_Gauss(nn.Module):
 
         # encoder function (phi_enc) -> Inference
         self.enc = nn.Sequential(
-            nn.Linear(self.h_dim + self.h_dim, self.h_dim),
+            concat_linear(self.h_dim, self.h_dim, self.h_dim, self.split_input_layers),
             nn.ReLU(),
             nn.Linear(self.h_dim, self.h_dim),
             nn.ReLU(),)
@@ -56,7 +65,7 @@ class VRNN_Gauss(nn.Module):
 
         # decoder function (phi_dec) -> Generation
         self.dec = nn.Sequential(
-            nn.Linear(self.h_dim + self.h_dim, self.h_dim),
+            concat_linear(self.h_dim, self.h_dim, self.h_dim, self.split_input_layers),
             nn.ReLU(),
             nn.Linear(self.h_dim, self.h_dim),
             nn.ReLU(),)
@@ -69,111 +78,139 @@ class VRNN_Gauss(nn.Module):
             nn.ReLU(),)
 
         # recurrence function (f_theta) -> Recurrence
-        self.rnn = nn.GRU(self.h_dim + self.h_dim, self.h_dim, self.n_layers, bias)  # , batch_first=True)
-
-    def forward(self, u, y):
+        self.rnn = concat_gru(self.h_dim, self.h_dim, self.h_dim, self.n_layers, bias, self.split_input_layers,
+                              self.fused_gru)
+
+    def forward(self, u, y, noise=None, state=None, return_state=False):
+        # state: initial recurrent state h, e.g. the final state of the previous window (truncated BPTT), returned
+        # after the loss if return_state
+        # time major views (seq_len, batch, channels)
+        u = to_time_major(u, self.time_major)
+        y = to_time_major(y, self.time_major)
         #  batch size
-        batch_size = y.shape[0]
-        seq_len = y.shape[2]
-        # allocation
-        loss = 0
+        batch_size = y.shape[1]
+        seq_len = y.shape[0]
         # initialization
-        h = torch.zeros(self.n_layers, batch_size, self.h_dim, device=self.device)
+        h = torch.zeros(self.n_layers, batch_size, self.h_dim, device=self.device) if state is None else state
+
+        # feature extraction: y and u for all time steps
+        phi_y = extract_features(self.phi_y, y, self.precompute_features)
+        phi_u = extract_features(self.phi_u, u, self.precompute_features)
+        # input projections of y and u which do not depend on the recurrence
+        enc_y = time_steps(project_input(self.enc, phi_y))
+        rnn_u = time_steps(project_input(self.rnn, phi_u))
+
+        # noise of the samples of z_t
+        eps_z = noise_steps(noise, 'z', (seq_len, batch_size, self.z_dim), self.device, self.predraw_noise)
+
+        # for all time steps (segments of checkpoint_segment time steps evaluated again in the backward pass)
+        h, outputs = run_steps(get_step(self, 'step'), h, lambda t: (enc_y[t], rnn_u[t], eps_z[t]), seq_len,
+                               self.checkpoint_segment)
+        # distribution parameters of all time steps, shape (seq_len, batch, dim)
+        enc_mean, enc_logvar, prior_mean, prior_logvar, dec_mean, dec_logvar = outputs
+
+        # computing the loss over all time steps
+        KLD = kld_gauss(enc_mean, enc_logvar, prior_mean, prior_logvar)
+        loss_pred = loglikelihood_gauss(y, dec_mean, dec_logvar)
+        loss = - loss_pred + KLD
+
+        if return_state:
+            return loss, h
+        return loss
 
+    def step(self, h, inputs):
+        # single time step of the inference model: h_t, (enc_y_t, rnn_u_t, eps_z_t) -> h_t+1, (distribution parameters
+        # of step t) with the input projections enc_y_t of y_t and rnn_u_t of u_t and the noise eps_z_t of the sample of
+        # z_t (the loss is evaluated for all time steps at once)
+        enc_y_t, rnn_u_t, eps_z_t = inputs
 
-        # for all time steps
-        for t in range(seq_len):
-            # feature extraction: y_t
-            phi_y_t = self.phi_y(y[:, :, t])
-            # feature extraction: u_t
-            phi_u_t = self.phi_u(u[:, :, t])
-
-            # encoder: y_t, h_t -> z_t
-            enc_t = self.enc(torch.cat([phi_y_t, h[-1]], 1))
-            enc_mean_t = self.enc_mean(enc_t)
-            enc_logvar_t = self.enc_logvar(enc_t)
-
-            # prior: h_t -> z_t (for KLD loss)
-            prior_t = self.prior(h[-1])
-            prior_mean_t = self.prior_mean(prior_t)
-            prior_logvar_t = self.prior_logvar(prior_t)
-
-            # sampling and reparameterization: get a new z_t
-            temp = tdist.Normal(enc_mean_t, enc_logvar_t.exp().sqrt())
-            z_t = tdist.Normal.rsample(temp)
-            # feature extraction: z_t
-            phi_z_t = self.phi_z(z_t)
-
-            # decoder: h_t, z_t -> y_t
-            dec_t = self.dec(torch.cat([phi_z_t, h[-1]], 1))
-            dec_mean_t = self.dec_mean(dec_t)
-            dec_logvar_t = self.dec_logvar(dec_t)
-            pred_dist = tdist.Normal(dec_mean_t, dec_logvar_t.exp().sqrt())
-
-            # recurrence: u_t+1, z_t -> h_t+1
-            _, h = self.rnn(torch.cat([phi_u_t, phi_z_t], 1).unsqueeze(0), h)  # phi_h_t
-
-            # computing the loss
-            KLD = self.kld_gauss(enc_mean_t, enc_logvar_t, prior_mean_t, prior_logvar_t)
-            loss_pred = torch.sum(pred_dist.log_prob(y[:, :, t]))
-            loss += - loss_pred + KLD
+        # encoder: y_t, h_t -> z_t
+        enc_t = forward_with_state(self.enc, enc_y_t, h[-1])
+        enc_mean_t = self.enc_mean(enc_t)
+        enc_logvar_t = self.enc_logvar(enc_t)
 
-        return loss
+        # prior: h_t -> z_t (for KLD loss)
+        prior_t = self.prior(h[-1])
+        prior_mean_t = self.prior_mean(prior_t)
+        prior_logvar_t = self.prior_logvar(prior_t)
+
+        # sampling and reparameterization: get a new z_t
+        z_t = sample_gauss(enc_mean_t, enc_logvar_t, eps_z_t)
+        # feature extraction: z_t
+        phi_z_t = self.phi_z(z_t)
 
-    def generate(self, u):
+        # decoder: h_t, z_t -> y_t
+        dec_t = forward_with_state(self.dec, project_input(self.dec, phi_z_t), h[-1])
+        dec_mean_t = self.dec_mean(dec_t)
+        dec_logvar_t = self.dec_logvar(dec_t)
+
+        # recurrence: u_t+1, z_t -> h_t+1
+        h = rnn_step(self.rnn, rnn_u_t, phi_z_t, h)
+
+        return h, (enc_mean_t, enc_logvar_t, prior_mean_t, prior_logvar_t, dec_mean_t, dec_logvar_t)
+
+    def generate(self, u, noise=None):
+        # time major view (seq_len, batch, channels)
+        u = to_time_major(u, self.time_major)
         # get the batch size
-        batch_size = u.shape[0]
+        batch_size = u.shape[1]
         # length of the sequence to generate
-        seq_len = u.shape[-1]
+        seq_len = u.shape[0]
 
         # allocation
-        sample = torch.zeros(batch_size, self.y_dim, seq_len, device=self.device)
-        sample_mu = torch.zeros(batch_size, self.y_dim, seq_len, device=self.device)
-        sample_sigma = torch.zeros(batch_size, self.y_dim, seq_len, device=self.device)
+        sample = torch.zeros(seq_len, batch_size, self.y_dim, device=self.device)
+        sample_mu = torch.zeros(seq_len, batch_size, self.y_dim, device=self.device)
+        sample_sigma = torch.zeros(seq_len, batch_size, self.y_dim, device=self.device)
         h = torch.zeros(self.n_layers, batch_size, self.h_dim, device=self.device)
 
+        # feature extraction: u for all time steps
+        phi_u = extract_features(self.phi_u, u, self.precompute_features)
+        # input projection of u which does not depend on the recurrence
+        rnn_u = time_steps(project_input(self.rnn, phi_u))
+
+        # noise of the samples of z_t and y_t
+        eps_z = noise_steps(noise, 'z', (seq_len, batch_size, self.z_dim), self.device, self.predraw_noise)
+        eps_y = noise_steps(noise, 'y', (seq_len, batch_size, self.y_dim), self.device, self.predraw_noise)
+
         # for all time steps
+        step = get_step(self, 'step_generate')
         for t in range(seq_len):
-            # feature extraction: u_t+1
-            phi_u_t = self.phi_u(u[:, :, t])
-
-            # prior: h_t -> z_t
-            prior_t = self.prior(h[-1])
-            prior_mean_t = self.prior_mean(prior_t)
-            prior_logvar_t = self.prior_logvar(prior_t)
-
-            # sampling and reparameterization: get new z_t
-            temp = tdist.Normal(prior_mean_t, prior_logvar_t.exp().sqrt())
-            z_t = tdist.Normal.rsample(temp)
-            # feature extraction: z_t
-            phi_z_t = self.phi_z(z_t)
-
-            # decoder: z_t, h_t -> y_t
-            dec_t = self.dec(torch.cat([phi_z_t, h[-1]], 1))
-            dec_mean_t = self.dec_mean(dec_t)
-            dec_logvar_t = self.dec_logvar(dec_t)
-            # store the samples
-            temp = tdist.Normal(dec_mean_t, dec_logvar_t.exp().sqrt())
-            sample[:, :, t] = tdist.Normal.rsample(temp)
-            # store mean and std
-            sample_mu[:, :, t] = dec_mean_t
-            sample_sigma[:, :, t] = dec_logvar_t.exp().sqrt()
-
-            # recurrence: u_t+1, z_t -> h_t+1
-            _, h = self.rnn(torch.cat([phi_u_t, phi_z_t], 1).unsqueeze(0), h)
+            h, (sample[t], sample_mu[t], sample_sigma[t]) = step(h, (rnn_u[t], eps_z[t], eps_y[t]))
 
-        return sample, sample_mu, sample_sigma
+        # back to the layout of u
+        sample = from_time_major(sample, self.time_major)
+        sample_mu = from_time_major(sample_mu, self.time_major)
+        sample_sigma = from_time_major(sample_sigma, self.time_major)
 
-    @staticmethod
-    def kld_gauss(mu_q, logvar_q, mu_p, logvar_p):
-        # Goal: Minimize KL divergence between q_pi(z|xi) || p(z|xi)
-        # This is equivalent to maximizing the ELBO: - D_KL(q_phi(z|xi) || p(z)) + Reconstruction term
-        # This is equivalent to minimizing D_KL(q_phi(z|xi) || p(z))
-        term1 = logvar_p - logvar_q - 1
-        term2 = (torch.exp(logvar_q) + (mu_q - mu_p) ** 2) / torch.exp(logvar_p)
-        kld = 0.5 * torch.sum(term1 + term2)
+        return sample, sample_mu, sample_sigma
 
-        return kld
+    def step_generate(self, h, inputs):
+        # single time step of the generative model: h_t, (rnn_u_t, eps_z_t, eps_y_t) -> h_t+1, (sample_t, mean_t, std_t)
+        # with the input projection rnn_u_t of u_t and the noise eps_z_t and eps_y_t of the samples of z_t and y_t
+        rnn_u_t, eps_z_t, eps_y_t = inputs
+
+        # prior: h_t -> z_t
+        prior_t = self.prior(h[-1])
+        prior_mean_t = self.prior_mean(prior_t)
+        prior_logvar_t = self.prior_logvar(prior_t)
+
+        # sampling and reparameterization: get new z_t
+        z_t = sample_gauss(prior_mean_t, prior_logvar_t, eps_z_t)
+        # feature extraction: z_t
+        phi_z_t = self.phi_z(z_t)
+
+        # decoder: z_t, h_t -> y_t
+        dec_t = forward_with_state(self.dec, project_input(self.dec, phi_z_t), h[-1])
+        dec_mean_t = self.dec_mean(dec_t)
+        dec_logvar_t = self.dec_logvar(dec_t)
+        dec_sigma_t = dec_logvar_t.exp().sqrt()
+        # sample
+        sample_t = sample_gauss(dec_mean_t, dec_logvar_t, eps_y_t)
+
+        # recurrence: u_t+1, z_t -> h_t+1
+        h = rnn_step(self.rnn, rnn_u_t, phi_z_t, h)
+
+        return h, (sample_t, dec_mean_t, dec_sigma_t)
 
     def init_rnn_output(self, batch_size, seq_len):
         phi_h_t = torch.zeros(batch_size, seq_len, self.h_dim).to(self.device)
@@ -2,6 +2,8 @@ import argparse
 
 
 def get_dataset_options(dataset_name):
+    # the dataset, model, train and test options are parsed from the same command line, hence the arguments of the
+    # other parsers are skipped (parse_known_args)
 
     """Not used datasets"""
     """if dataset_name == 'cascaded_tank':
@@ -11,7 +13,7 @@ def get_dataset_options(dataset_name):
         dataset_parser.add_argument('--seq_len_train', type=int, default=128, help='training sequence length')
         dataset_parser.add_argument('--seq_len_test', type=int, default=None, help='test sequence length')
         dataset_parser.add_argument('--seq_len_val', type=int, default=128, help='validation sequence length')
-        dataset_options = dataset_parser.parse_args()
+        dataset_options = dataset_parser.parse_known_args()[0]
 
     elif dataset_name == 'f16gvt':
         dataset_parser = argparse.ArgumentParser(description='dynamic system parameter: f-16')
@@ -20,7 +22,7 @@ def get_dataset_options(dataset_name):
         dataset_parser.add_argument('--seq_len_train', type=int, default=2048, help='training sequence length')
         dataset_parser.add_argument('--seq_len_test', type=int, default=2048, help='test sequence length')
         dataset_parser.add_argument('--seq_len_val', type=int, default=2048, help='validation sequence length')
-        dataset_options = dataset_parser.parse_args()"""
+        dataset_options = dataset_parser.parse_known_args()[0]"""
 
     if dataset_name == 'narendra_li':
         dataset_parser = argparse.ArgumentParser(description='dynamic system parameter: narendra li')
@@ -29,7 +31,7 @@ def get_dataset_options(dataset_name):
         dataset_parser.add_argument('--seq_len_train', type=int, default=2000, help='training sequence length')
         dataset_parser.add_argument('--seq_len_test', type=int, default=None, help='test sequence length')
         dataset_parser.add_argument('--seq_len_val', type=int, default=2000, help='validation sequence length')  # 512
-        dataset_options = dataset_parser.parse_args()
+        dataset_options = dataset_parser.parse_known_args()[0]
 
     elif dataset_name == 'toy_lgssm':
         dataset_parser = argparse.ArgumentParser(description='dynamic system parameter: lgssm')
@@ -38,7 +40,7 @@ def get_dataset_options(dataset_name):
         dataset_parser.add_argument('--seq_len_train', type=int, default=64, help='training sequence length')
         dataset_parser.add_argument('--seq_len_test', type=int, default=None, help='test sequence length')
         dataset_parser.add_argument('--seq_len_val', type=int, default=64, help='validation sequence length')  # 512
-        dataset_options = dataset_parser.parse_args()
+        dataset_options = dataset_parser.parse_known_args()[0]
 
     elif dataset_name == 'wiener_hammerstein':
         dataset_parser = argparse.ArgumentParser(description='dynamic system parameter: wiener hammerstein')
@@ -47,6 +49,6 @@ def get_dataset_options(dataset_name):
         dataset_parser.add_argument('--seq_len_train', type=int, default=2048, help='training sequence length')
         dataset_parser.add_argument('--seq_len_test', type=int, default=None, help='test sequence length')
         dataset_parser.add_argument('--seq_len_val', type=int, default=2048, help='validation sequence length')
-        dataset_options = dataset_parser.parse_args()
+        dataset_options = dataset_parser.parse_known_args()[0]
 
     return dataset_options
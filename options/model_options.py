@@ -41,6 +41,36 @@ def get_model_options(model_type, dataset_name, dataset_options):
     if model_type == 'VRNN-GMM-I' or model_type == 'VRNN-GMM':
         model_parser.add_argument('--n_mixtures', type=int, default=5, help='number Gaussian output mixtures')
 
-    model_options = model_parser.parse_args()
+    # computational options
+    model_parser.add_argument('--no_precompute_features', dest='precompute_features', action='store_false',
+                              help='evaluate the feature extraction of u and y in every time step instead of once for '
+                                   'the whole sequence')
+    model_parser.add_argument('--split_input_layers', action='store_true',
+                              help='separate weights for input and state in the first encoder, decoder and GRU layer '
+                                   'instead of concatenating both in every time step')
+    model_parser.add_argument('--fused_gru', action='store_true',
+                              help='evaluate the GRU recurrence inside the time loop with the fused step engine '
+                                   '(precomputed input projections, all layers in one step)')
+    model_parser.add_argument('--compile_step', action='store_true',
+                              help='run the time loops through the torch.compile version of the step functions '
+                                   '(compiled once per architecture)')
+    model_parser.add_argument('--predraw_noise', action='store_true',
+                              help='draw the noise of all samples of a forward or generate call upfront as contiguous '
+                                   '(seq_len, batch, dim) blocks instead of in every time step')
+    model_parser.add_argument('--time_major', action='store_true',
+                              help='load and process the data in the contiguous time major layout (seq_len, batch, '
+                                   'channels) instead of (batch, channels, seq_len)')
+    model_parser.add_argument('--checkpoint_segment', type=int, default=0,
+                              help='gradient checkpointing along time in the time loops of training: keep the states '
+                                   'only every n time steps and evaluate the steps in between again in the backward '
+                                   'pass (0: off)')
+    model_parser.add_argument('--mixed_precision', action='store_true',
+                              help='bfloat16 mixed precision (autocast) in training and generation: the linear layers '
+                                   'run in bfloat16, the loss terms, recurrent states and normalizers stay in float32 '
+                                   '(with --fused_gru the GRU projections run in bfloat16 as well)')
+
+    # the dataset, model, train and test options are parsed from the same command line, hence the arguments of the
+    # other parsers are skipped (parse_known_args)
+    model_options = model_parser.parse_known_args()[0]
 
     return model_options
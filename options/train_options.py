@@ -6,7 +6,8 @@ def get_train_options(dataset_name):
     train_parser = argparse.ArgumentParser(description='training parameter')
     train_parser.add_argument('--clip', type=int, default=10, help='clipping of gradients')
     train_parser.add_argument('--lr_scheduler_nstart', type=int, default=10, help='learning rate scheduler start epoch')
-    train_parser.add_argument('--print_every', type=int, default=1, help='output print of training')
+    train_parser.add_argument('--print_every', type=int, default=50,
+                              help='output print of training every n batches (0: only after validation)')
     train_parser.add_argument('--test_every', type=int, default=5, help='test during training after every n epoch')
 
     """Not used datasets"""
@@ -51,15 +52,60 @@ def get_train_options(dataset_name):
     else:
         train_parser.add_argument('--batch_size', type=int, default=128, help='batch size')
 
+    # early stopping (besides the learning rate falling below min_lr)
+    train_parser.add_argument('--patience', type=int, default=0,
+                              help='stop if the validation loss did not improve for n epochs (0: no patience stop)')
+    train_parser.add_argument('--max_time', type=float, default=0,
+                              help='maximum wall clock time of the training in seconds (0: no limit)')
+    train_parser.add_argument('--target_vloss', type=float, default=None,
+                              help='stop as soon as the validation loss reaches this value')
 
-    train_options = train_parser.parse_args()
+    # data handling
+    train_parser.add_argument('--device_resident', action='store_true',
+                              help='move the training and validation data to the computing device once and gather the '
+                                   'batches there instead of transferring every batch')
+    train_parser.add_argument('--full_batch', action='store_true',
+                              help='train on the whole training set as a single batch per epoch (ignores batch_size)')
+    train_parser.add_argument('--no_shuffle', dest='shuffle', action='store_false',
+                              help='train on fixed slices of the training set instead of shuffled batches')
+    train_parser.add_argument('--tbptt', action='store_true',
+                              help='truncated backpropagation through time: the batches hold consecutive windows of '
+                                   'batch_size streams and the final (detached) recurrent state of a batch is the '
+                                   'initial state of the next one')
+    train_parser.add_argument('--train_loss', type=str, default='full', choices=['full', 'running', 'subsample'],
+                              help='training loss reported every test_every epochs: full pass over the training set, '
+                                   'running average over the last training epoch or full pass over a fixed random '
+                                   'subsample of the training windows')
+    train_parser.add_argument('--train_loss_subsample', type=int, default=64,
+                              help='number of training windows of the subsample for train_loss=subsample')
+    train_parser.add_argument('--resume_every', type=int, default=10,
+                              help='save the training state to resume an interrupted training every n epochs '
+                                   '(0: never)')
+    train_parser.add_argument('--no_async_checkpoint', dest='async_checkpoint', action='store_false',
+                              help='save the best model synchronously instead of on a background thread')
+    train_parser.add_argument('--step_timing', action='store_true',
+                              help='print the time per training step split into data, forward, backward, optimizer '
+                                   'and logging after every epoch (synchronizes the device after every phase)')
+    train_parser.add_argument('--autotune', action='store_true',
+                              help='benchmark a few training steps for candidate numbers of threads and batch sizes '
+                                   '(1/4 to 4 times batch_size) before the training and use the configuration with '
+                                   'the most samples per second')
+    train_parser.add_argument('--autotune_cache', type=str, default='log/autotune.json',
+                              help='file of the autotuned configurations per model, h_dim, z_dim, n_layers and '
+                                   'seq_len, reused in later runs')
+
+
+    # the dataset, model, train and test options are parsed from the same command line, hence the arguments of the
+    # other parsers are skipped (parse_known_args)
+    train_options = train_parser.parse_known_args()[0]
 
     return train_options
 
 
 def get_test_options():
     test_parser = argparse.ArgumentParser(description='testing parameter')
-    test_parser.add_argument('--batch_size', type=int, default=32, help='batch size')  # 128
-    test_options = test_parser.parse_args()
+    # --test_batch_size: --batch_size is the one of the training
+    test_parser.add_argument('--test_batch_size', dest='batch_size', type=int, default=32, help='batch size')  # 128
+    test_options = test_parser.parse_known_args()[0]
 
     return test_options
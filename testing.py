@@ -7,6 +7,7 @@ import utils.dataevaluater as de
 from utils.utils import get_n_params
 from models.model_state import ModelState
 from utils.utils import compute_normalizer
+from training import get_rng_state, set_rng_state
 
 
 def run_test(options, loaders, df, path_general, file_name_general, **kwargs):
@@ -29,6 +30,7 @@ def run_test(options, loaders, df, path_general, file_name_general, **kwargs):
                             normalizer_input=normalizer_input,
                             normalizer_output=normalizer_output)
     modelstate.model.to(options['device'])
+    modelstate.model.check_layout(loaders['test'])
 
     # load model
     path = path_general + 'model/'
@@ -59,7 +61,23 @@ def run_test(options, loaders, df, path_general, file_name_general, **kwargs):
     for i, (u_test, y_test) in enumerate(loaders['test']):
         # getting output distribution parameter only implemented for selected models
         u_test = u_test.to(options['device'])
+        rng_state = get_rng_state()
         y_sample, y_sample_mu, y_sample_sigma = modelstate.model.generate(u_test)
+        if modelstate.model.mixed_precision:
+            # float32 reference with the same random numbers for the accuracy of the mixed precision generation
+            set_rng_state(rng_state)
+            modelstate.model.mixed_precision = False
+            _, y_sample_mu_ref, y_sample_sigma_ref = modelstate.model.generate(u_test)
+            modelstate.model.mixed_precision = True
+        if loaders['test'].time_major:
+            # back to shape (batch, y_dim, seq_len) for the evaluation
+            y_test = y_test.permute(1, 2, 0)
+            y_sample = y_sample.permute(1, 2, 0)
+            y_sample_mu = y_sample_mu.permute(1, 2, 0)
+            y_sample_sigma = y_sample_sigma.permute(1, 2, 0)
+            if modelstate.model.mixed_precision:
+                y_sample_mu_ref = y_sample_mu_ref.permute(1, 2, 0)
+                y_sample_sigma_ref = y_sample_sigma_ref.permute(1, 2, 0)
 
         # convert to cpu and to numpy for evaluation
         # samples data
@@ -68,6 +86,9 @@ def run_test(options, loaders, df, path_general, file_name_general, **kwargs):
         # test data
         y_test = y_test.cpu().detach().numpy()
         y_sample = y_sample.cpu().detach().numpy()
+        if modelstate.model.mixed_precision:
+            y_sample_mu_ref = y_sample_mu_ref.cpu().detach().numpy()
+            y_sample_sigma_ref = y_sample_sigma_ref.cpu().detach().numpy()
 
     # get noisy test data for narendra_li
     if options['dataset'] == 'narendra_li':
@@ -122,6 +143,15 @@ def run_test(options, loaders, df, path_general, file_name_general, **kwargs):
     # compute RMSE
     rmse = de.compute_rmse(y_test_noisy, y_sample_mu, doprint=True)
 
+    # accuracy of the mixed precision generation: deviations of the performance values from the float32 reference
+    if modelstate.model.mixed_precision:
+        marginal_likeli_delta = marginal_likeli - de.compute_marginalLikelihood(y_test_noisy, y_sample_mu_ref,
+                                                                                y_sample_sigma_ref)
+        vaf_delta = vaf - de.compute_vaf(y_test_noisy, y_sample_mu_ref)
+        rmse_delta = rmse - de.compute_rmse(y_test_noisy, y_sample_mu_ref)
+        print('Mixed precision - float32: Marginal Likelihood / point {:.2e}, VAF {:.2e}%, RMSE {}'.format(
+            marginal_likeli_delta, vaf_delta, ', '.join('{:.2e}'.format(delta) for delta in rmse_delta)))
+
     # %% Collect data
 
     # options_dict
@@ -137,6 +167,10 @@ def run_test(options, loaders, df, path_general, file_name_general, **kwargs):
     test_dict = {'marginal_likeli': marginal_likeli,
                  'vaf': vaf,
                  'rmse': rmse}
+    if modelstate.model.mixed_precision:
+        test_dict.update({'marginal_likeli_delta': marginal_likeli_delta,
+                          'vaf_delta': vaf_delta,
+                          'rmse_delta': rmse_delta})
     # dataframe
     df.update(options_dict)
     df.update(test_dict)
@@ -0,0 +1,26 @@
+import os
+import sys
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.gaussian import loglikelihood_gmm
+
+
+def test_loglikelihood_gmm_saturated_weights():
+    # a mixture weight of the softmax underflowing to exactly zero must not give NaN gradients
+    logits = torch.tensor([[[0., -200., 1.]]], requires_grad=True)
+    pi = torch.softmax(logits, -1)
+    assert (pi == 0).any()
+    x = torch.zeros(1, 1)
+    mu = torch.zeros(1, 1, 3)
+    logvar = torch.zeros(1, 1, 3)
+
+    loss = - loglikelihood_gmm(x, mu, logvar, pi)
+    loss.backward()
+
+    assert torch.isfinite(loss)
+    assert torch.isfinite(logits.grad).all()
+
+
+if __name__ == '__main__':
+    test_loglikelihood_gmm_saturated_weights()
@@ -1,15 +1,27 @@
 import os
+import copy
+import json
 import torch
 import torch.nn as nn
 import torch.utils
 import torch.utils.data
+import torch.distributed as dist
 import numpy as np
 import time
+from utils.utils import StepTimer
 
+# default number of threads of the process (upper limit of the autotuning, independent of earlier runs)
+_NUM_THREADS = torch.get_num_threads()
+# computational options in the key of the autotuning cache
+_AUTOTUNE_OPTIONS = ('mixed_precision', 'fused_gru', 'split_input_layers', 'checkpoint_segment')
 
-def run_train(modelstate, loader_train, loader_valid, options, dataframe, path_general, file_name_general):
+
+def run_train(modelstate, loader_train, loader_valid, options, dataframe, path_general, file_name_general,
+              resume=None):
+    # resume: checkpoint with the training state (see resume_train) to continue from instead of starting a new training
     def validate(loader):
         modelstate.model.eval()
+        # losses are accumulated on the device and read back once
         total_vloss = 0
         total_batches = 0
         total_points = 0
@@ -19,11 +31,14 @@ def run_train(modelstate, loader_train, loader_valid, options, dataframe, path_g
                 y = y.to(options['device'])
                 vloss_ = modelstate.model(u, y)
 
-                total_batches += u.size()[0]
-                total_points += np.prod(u.shape)
-                total_vloss += vloss_.item()
+                total_batches += u.shape[1] if loader.time_major else u.shape[0]
+                total_points += u.numel()
+                total_vloss += vloss_
+
+        # sum over the shards of all ranks
+        total_vloss, total_points = all_reduce_sum(total_vloss, total_points)
 
-        return total_vloss / total_points  # total_batches
+        return float(total_vloss) / total_points  # total_batches
 
     def train(epoch):
         # model in training mode
@@ -32,74 +47,171 @@ def run_train(modelstate, loader_train, loader_valid, options, dataframe, path_g
         total_loss = 0
         total_batches = 0
         total_points = 0
+        # optional breakdown of the step time (synchronizes the device after every phase)
+        timer = StepTimer(options['device']) if train_options.step_timing else None
+        # truncated BPTT: recurrent state carried over the consecutive windows of the batches of a stateful loader
+        state = None
 
         for i, (u, y) in enumerate(loader_train):
             u = u.to(options['device'])
             y = y.to(options['device'])
+            if timer is not None:
+                timer.lap('data')
 
             # set the optimizer
             modelstate.optimizer.zero_grad()
             # forward pass over model
-            loss_ = modelstate.model(u, y)
+            if loader_train.stateful:
+                loss_, state = modelstate.model(u, y, state=state, return_state=True)
+                # no backpropagation into the previous window
+                state = detach_state(state)
+            else:
+                loss_ = modelstate.model(u, y)
+            if timer is not None:
+                timer.lap('forward')
             # NN optimization
             loss_.backward()
+            if world_size > 1:
+                all_reduce_gradients(modelstate.model)
+            if timer is not None:
+                timer.lap('backward')
             modelstate.optimizer.step()
+            if timer is not None:
+                timer.lap('optimizer')
 
-            total_batches += u.size()[0]
-            total_points += np.prod(u.shape)
-            total_loss += loss_.item()
+            # loss accumulated on the device (no synchronization in every step)
+            total_batches += u.shape[1] if loader_train.time_major else u.shape[0]
+            total_points += u.numel()
+            total_loss += loss_.detach()
 
-            # output to console
-            if i % train_options.print_every == 0:
+            # output to console every print_every batches (reads back the loss)
+            if rank == 0 and train_options.print_every > 0 and (i + 1) % train_options.print_every == 0:
                 print(
                     'Train Epoch: [{:5d}/{:5d}], Batch [{:6d}/{:6d} ({:3.0f}%)]\tLearning rate: {:.2e}\tLoss: {:.3f}'.format(
                         epoch, train_options.n_epochs, (i + 1), len(loader_train),
-                        100. * (i + 1) / len(loader_train), lr, total_loss / total_points))  # total_batches
+                        100. * (i + 1) / len(loader_train), lr, float(total_loss) / total_points))  # total_batches
+            if timer is not None:
+                timer.lap('logging')
+
+        if rank == 0 and timer is not None:
+            print('Step time [ms]: {}'.format(timer.summary(len(loader_train))))
+
+        total_loss, total_points = all_reduce_sum(total_loss, total_points)
+
+        return float(total_loss) / total_points
+
+    # reason of the end of the training (n_epochs: all epochs trained)
+    stop_reason = None
+    # data parallel training if a torch.distributed process group is initialized (see init_distributed): every rank
+    # trains on its shard of the windows and the gradients and losses are summed over all ranks
+    rank, world_size = get_rank()
+    modelstate.model.check_layout(loader_train)
+    modelstate.model.check_layout(loader_valid)
 
-        return total_loss / total_points
+    # number of threads and batch size of the most samples per second (cached per architecture and setup), applied to
+    # this run only: the number of threads is restored at the end and the options are not changed. Outside of the try
+    # block, an interruption of the benchmark ends the run before the training
+    num_threads_default = torch.get_num_threads()
+    autotune_dict = {}
+    if options['train_options'].autotune and world_size == 1:
+        num_threads, loader_train.batch_size = autotune(modelstate.model, loader_train, options)
+        torch.set_num_threads(num_threads)
+        autotune_dict = {'num_threads': num_threads, 'train_batch_size': loader_train.batch_size}
 
     try:
         model_options = options['model_options']
         train_options = options['train_options']
 
+        # data handling of the training loader (in memory TensorLoaders)
+        loader_train.shuffle = train_options.shuffle
+        loader_train.stateful = train_options.tbptt
+        if train_options.full_batch:
+            loader_train.batch_size = loader_train.n_samples
+        if train_options.device_resident:
+            # the data stays on the computing device, the batches are gathered there (u.to(device) is a no-op)
+            loader_train.to(options['device'])
+            loader_valid.to(options['device'])
+
+        # loader of the training loss estimate every test_every epochs (None: running average of the training epoch)
+        if train_options.train_loss == 'full':
+            train_loss_idx = None
+            loader_train_loss = loader_train
+        elif train_options.train_loss == 'subsample':
+            n_subsample = min(train_options.train_loss_subsample, loader_train.n_samples)
+            train_loss_idx = torch.randperm(loader_train.n_samples)[:n_subsample].sort()[0] if resume is None \
+                else resume['train_loss_idx']
+            loader_train_loss = loader_train.subset(train_loss_idx, batch_size=loader_valid.batch_size)
+        else:
+            train_loss_idx = None
+            loader_train_loss = None
+
+        if world_size > 1:
+            # shards of the same number of batches with the batch size split over the ranks (same global batch)
+            batch_size = max(1, loader_train.batch_size // world_size)
+            loader_train = loader_train.shard(rank, world_size, batch_size=batch_size)
+            loader_valid = loader_valid.shard(rank, world_size, drop_remainder=False)
+            if train_options.train_loss != 'running':
+                loader_train_loss = loader_train_loss.shard(rank, world_size, drop_remainder=False)
+            # same initial model on all ranks and different random numbers (noise, shuffling) per rank
+            broadcast_model(modelstate.model)
+            torch.manual_seed(torch.initial_seed() + rank)
+
         modelstate.model.train()
-        # Train
-        vloss = validate(loader_valid)
-        all_losses = []
-        all_vlosses = []
-        best_vloss = vloss
-        start_time = time.time()
+        if resume is None:
+            # Train
+            vloss = validate(loader_valid)
+            all_losses = []
+            all_vlosses = []
+            best_vloss = vloss
+            start_time = time.time()
 
-        # Extract initial learning rate
-        lr = train_options.init_lr
+            # Extract initial learning rate
+            lr = train_options.init_lr
 
-        # output parameter
-        best_epoch = 0
+            # output parameter
+            best_epoch = 0
+            epoch = -1
+        else:
+            # state at the end of epoch resume['epoch']
+            all_losses = resume['all_losses']
+            all_vlosses = resume['all_vlosses']
+            vloss = resume['vloss']
+            best_vloss = resume['best_vloss']
+            best_epoch = resume['best_epoch']
+            lr = resume['lr']
+            epoch = resume['epoch']
+            start_time = time.time() - resume['elapsed_time']
+            # random number generators of all ranks in data parallel training
+            set_rng_state(resume['rng_state'][rank] if world_size > 1 else resume['rng_state'])
+            print('Resume training after epoch {}'.format(epoch))
 
-        for epoch in range(0, train_options.n_epochs + 1):
+        for epoch in range(epoch + 1, train_options.n_epochs + 1):
             # Train and validate
-            train(epoch)  # model, train_options, loader_train, optimizer, epoch, lr)
+            loss_epoch = train(epoch)  # model, train_options, loader_train, optimizer, epoch, lr)
             # validate every n epochs
             if epoch % train_options.test_every == 0:
                 vloss = validate(loader_valid)
-                loss = validate(loader_train)
+                loss = loss_epoch if loader_train_loss is None else validate(loader_train_loss)
                 # Save losses
                 all_losses += [loss]
                 all_vlosses += [vloss]
 
                 if vloss < best_vloss:  # epoch == train_options.n_epochs:  #
                     best_vloss = vloss
-                    # save model
+                    # save model (checkpoints are written by rank 0 only)
                     path = path_general + 'model/'
                     file_name = file_name_general + '_bestModel.ckpt'
-                    modelstate.save_model(epoch, vloss, time.clock() - start_time, path, file_name)
+                    if rank == 0:
+                        modelstate.save_model(epoch, vloss, time.time() - start_time, path, file_name,
+                                              blocking=not train_options.async_checkpoint)
                     # torch.save(model.state_dict(), path + file_name)
                     best_epoch = epoch
 
                 # Print validation results
-                print('Train Epoch: [{:5d}/{:5d}], Batch [{:6d}/{:6d} ({:3.0f}%)]\tLearning rate: {:.2e}\tLoss: {:.3f}'
-                      '\tVal Loss: {:.3f}'.format(epoch, train_options.n_epochs, len(loader_train), len(loader_train),
-                                                  100., lr, loss, vloss))
+                if rank == 0:
+                    print('Train Epoch: [{:5d}/{:5d}], Batch [{:6d}/{:6d} ({:3.0f}%)]\tLearning rate: {:.2e}\tLoss: '
+                          '{:.3f}\tVal Loss: {:.3f}'.format(epoch, train_options.n_epochs, len(loader_train),
+                                                            len(loader_train), 100., lr, loss, vloss))
 
                 # lr scheduler
                 if epoch >= train_options.lr_scheduler_nstart:
@@ -110,18 +222,58 @@ def run_train(modelstate, loader_train, loader_valid, options, dataframe, path_g
                         # adapt new learning rate in the optimizer
                         for param_group in modelstate.optimizer.param_groups:
                             param_group['lr'] = lr
-                        print('\nLearning rate adapted! New learning rate {:.3e}\n'.format(lr))
-                # Early stoping condition
+                        if rank == 0:
+                            print('\nLearning rate adapted! New learning rate {:.3e}\n'.format(lr))
+                # Early stopping conditions
                 if lr < train_options.min_lr:
+                    stop_reason = 'min_lr'
+                elif train_options.target_vloss is not None and vloss <= train_options.target_vloss:
+                    stop_reason = 'target_vloss'
+                elif 0 < train_options.patience <= epoch - best_epoch:
+                    stop_reason = 'patience'
+                if stop_reason is not None:
                     break
 
+            # wall clock budget (time of rank 0, such that all ranks stop after the same epoch)
+            if 0 < train_options.max_time <= broadcast_scalar(time.time() - start_time):
+                stop_reason = 'max_time'
+                break
+
+            # resume checkpoint every resume_every epochs: the whole training state at the end of the epoch
+            if train_options.resume_every > 0 and (epoch + 1) % train_options.resume_every == 0:
+                rng_state = get_rng_state()
+                if world_size > 1:
+                    # random number generator states of all ranks
+                    rng_state = [None] * world_size
+                    dist.all_gather_object(rng_state, get_rng_state())
+                state = {'lr': lr,
+                         'all_losses': all_losses,
+                         'all_vlosses': all_vlosses,
+                         'best_vloss': best_vloss,
+                         'best_epoch': best_epoch,
+                         'train_loss_idx': train_loss_idx,
+                         'rng_state': rng_state}
+                if rank == 0:
+                    modelstate.save_model(epoch, vloss, time.time() - start_time, path_general + 'model/',
+                                          file_name_general + '_resume.ckpt',
+                                          blocking=not train_options.async_checkpoint, state=state)
+
     except KeyboardInterrupt:
         print('\n')
         print('-' * 89)
         print('Exiting from training early')
+        stop_reason = 'interrupted'
         # modelstate.save_model(epoch, vloss, time.clock() - start_time, logdir, 'interrupted_model.pt')
         print('-' * 89)
 
+    if stop_reason is None:
+        stop_reason = 'n_epochs'
+    print('Training stopped: {}'.format(stop_reason))
+
+    # wait for the checkpoints written in the background
+    modelstate.wait_checkpoints()
+    torch.set_num_threads(num_threads_default)
+
     # print best saved epoch model
     # print('\nBest model from epoch {} saved.'.format(best_epoch))
 
@@ -134,8 +286,167 @@ def run_train(modelstate, loader_train, loader_valid, options, dataframe, path_g
                   'all_vlosses': all_vlosses,
                   'best_epoch': best_epoch,
                   'total_epoch': epoch,
-                  'train_time': time_el}
+                  'train_time': time_el,
+                  'stop_reason': stop_reason}
+    # autotuned configuration of the run
+    train_dict.update(autotune_dict)
     # overall options
     dataframe.update(train_dict)
 
     return dataframe
+
+
+def resume_train(modelstate, loader_train, loader_valid, options, dataframe, path_general, file_name_general):
+    # continues an interrupted run_train (same options and file names) from its last resume checkpoint
+    file = path_general + 'model/' + file_name_general + '_resume.ckpt'
+    resume = modelstate.load_checkpoint(file)
+
+    return run_train(modelstate, loader_train, loader_valid, options, dataframe, path_general, file_name_general,
+                     resume=resume)
+
+
+def detach_state(state):
+    # recurrent state (tensor or tuple of tensors) without the graph of the previous window
+    if isinstance(state, tuple):
+        return tuple(detach_state(s) for s in state)
+    return state.detach()
+
+
+def get_rng_state():
+    # states of the random number generators of torch (cpu and cuda) and numpy. The numpy state (algorithm name, keys,
+    # position, cached gaussian) is stored as a list with the keys as a tensor, such that the resume checkpoints load
+    # with torch.load(..., weights_only=True)
+    algorithm, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    rng_state = {'torch': torch.get_rng_state(),
+                 'numpy': [algorithm, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian]}
+    if torch.cuda.is_available():
+        rng_state['cuda'] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+
+def set_rng_state(rng_state):
+    torch.set_rng_state(rng_state['torch'])
+    algorithm, keys, pos, has_gauss, cached_gaussian = rng_state['numpy']
+    np.random.set_state((algorithm, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    if 'cuda' in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+
+def autotune(model, loader_train, options, n_steps=3):
+    # benchmarks n_steps training steps of a copy of model for the candidate numbers of threads (powers of two up to
+    # the default number of the process) and batch sizes (1/4 to 4 times batch_size) and returns the configuration
+    # (num_threads, batch_size) with the most samples per second. The choice is cached in the file
+    # train_options.autotune_cache per model, h_dim, z_dim, n_layers, seq_len, batch_size, device and the computational
+    # options which change the throughput. The random number generators are restored afterwards
+    model_options = options['model_options']
+    train_options = options['train_options']
+    key = '{}_h{}_z{}_n{}_seq{}_batch{}_{}'.format(options['model'], model_options.h_dim, model_options.z_dim,
+                                                   model_options.n_layers, loader_train.dataset.seq_len,
+                                                   train_options.batch_size, torch.device(options['device']).type)
+    key += ''.join('_{}{}'.format(name, getattr(model_options, name)) for name in _AUTOTUNE_OPTIONS)
+    file = train_options.autotune_cache
+    cache = {}
+    if os.path.exists(file):
+        with open(file) as f:
+            cache = json.load(f)
+    if key in cache:
+        num_threads, batch_size = cache[key]['num_threads'], cache[key]['batch_size']
+        print('Autotune (cached): {} threads, batch size {}'.format(num_threads, batch_size))
+        return num_threads, batch_size
+
+    max_threads = _NUM_THREADS
+    threads = sorted({2 ** k for k in range(max_threads.bit_length())} | {max_threads})
+    batch_size = train_options.batch_size
+    batch_sizes = sorted({min(max(1, int(batch_size * factor)), loader_train.n_samples)
+                          for factor in (0.25, 0.5, 1, 2, 4)})
+
+    # training steps of a copy, the model itself is not changed
+    model = copy.deepcopy(model)
+    model.train()
+    optimizer = getattr(torch.optim, options['optim'])(model.parameters(), lr=train_options.init_lr)
+    rng_state = get_rng_state()
+    results = {}
+    for num_threads in threads:
+        torch.set_num_threads(num_threads)
+        for batch_size in batch_sizes:
+            u, y = next(iter(loader_train.subset(torch.arange(batch_size), batch_size)))
+            u = u.to(options['device'])
+            y = y.to(options['device'])
+            timer = StepTimer(options['device'])
+            for step in range(n_steps + 1):
+                optimizer.zero_grad()
+                model(u, y).backward()
+                optimizer.step()
+                # the first step is a warm up
+                timer.lap('step' if step > 0 else 'warmup')
+            results[num_threads, batch_size] = batch_size * n_steps / timer.times['step']
+            print('Autotune: {} threads, batch size {}: {:.1f} samples/s'.format(num_threads, batch_size,
+                                                                                results[num_threads, batch_size]))
+    set_rng_state(rng_state)
+
+    num_threads, batch_size = max(results, key=results.get)
+    print('Autotune: {} threads, batch size {}'.format(num_threads, batch_size))
+    cache[key] = {'num_threads': num_threads, 'batch_size': batch_size,
+                  'samples_per_second': results[num_threads, batch_size]}
+    path = os.path.dirname(file)
+    if path and not os.path.exists(path):
+        os.makedirs(path)
+    with open(file, 'w') as f:
+        json.dump(cache, f, indent=2)
+
+    return num_threads, batch_size
+
+
+def init_distributed():
+    # initializes the torch.distributed process group (gloo backend) from the environment variables of the
+    # rendezvous (MASTER_ADDR, MASTER_PORT, RANK, WORLD_SIZE, e.g. set by torchrun on localhost or across nodes) if
+    # the script was started as one of several processes, returns the rank and the number of processes
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not dist.is_initialized():
+        dist.init_process_group('gloo', init_method='env://')
+        # the cores of a node are shared by its processes
+        n_local = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        torch.set_num_threads(max(1, torch.get_num_threads() // n_local))
+    return get_rank()
+
+
+def get_rank():
+    # rank and number of processes of the torch.distributed process group (0, 1 if not distributed)
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def all_reduce_sum(*values):
+    # sums of the scalars values over all ranks (the values themselves if not distributed)
+    if get_rank()[1] == 1:
+        return values
+    total = torch.tensor([float(value) for value in values], dtype=torch.float64)
+    dist.all_reduce(total)
+    return total.tolist()
+
+
+def broadcast_scalar(value):
+    # scalar value of rank 0 on all ranks
+    if get_rank()[1] == 1:
+        return value
+    value = torch.tensor([float(value)], dtype=torch.float64)
+    dist.broadcast(value, 0)
+    return value.item()
+
+
+def broadcast_model(model):
+    # parameters and buffers of rank 0 on all ranks
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, 0)
+
+
+def all_reduce_gradients(model):
+    # sums the gradients over all ranks in a single flat buffer. The loss is summed over the samples, hence the sum of
+    # the gradients of the shards is the gradient of the global batch
+    grads = [param.grad for param in model.parameters() if param.grad is not None]
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
@@ -2,10 +2,39 @@ import torch
 import numpy as np
 import os
 import json
+import time
+from collections import OrderedDict
 from models.base import Normalizer1D
 
 
 
+class StepTimer(object):
+    """Accumulated wall clock time of the phases of the training steps. The device is synchronized at every lap, hence
+    the times are exact but the asynchronous execution on the device is stalled (diagnostics only)."""
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.times = OrderedDict()
+        self.last = self._now()
+
+    def _now(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def lap(self, phase):
+        # add the time since the last lap to phase
+        now = self._now()
+        self.times[phase] = self.times.get(phase, 0.) + now - self.last
+        self.last = now
+
+    def summary(self, n_steps):
+        # mean time per step of every phase in ms
+        total = sum(self.times.values())
+        phases = ['{} {:.2f}'.format(phase, 1e3 * t / n_steps) for phase, t in self.times.items()]
+        return ', '.join(phases + ['total {:.2f}'.format(1e3 * total / n_steps)])
+
+
 # get the number of model parameters
 def get_n_params(model_to_eval):
 
@@ -24,6 +53,10 @@ def compute_normalizer(loader_train):
     u_var = 0
     y_var = 0
     for i, (u, y) in enumerate(loader_train):
+        if loader_train.time_major:
+            # (seq_len, batch, channels) to (batch, channels, seq_len)
+            u = u.permute(1, 2, 0)
+            y = y.permute(1, 2, 0)
         total_batches += u.size()[0]
         u_mean += torch.mean(u, dim=(0, 2))
         y_mean += torch.mean(y, dim=(0, 2))